@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".ppm")
+ENCODING_SIZE = 128
+
+# Indexes are kept out of the photo folder, one per folder indexed
+FACE_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "abstergo", "faces")
+
+
+def encode_face(path):
+    # Encoding of the first face in a reference photo, or None
+    import face_recognition
+
+    found = face_recognition.face_encodings(face_recognition.load_image_file(path))
+    return found[0] if found else None
+
+
+class FaceGallery:
+    def __init__(self, root="face_data", index_dir=None, encoder=encode_face):
+        # Reference photos live in root/<person>/, or directly in root named
+        # after the person. Their encodings are kept in a memory-mapped
+        # matrix next to a manifest, so only new or changed photos are
+        # encoded again
+        self.root = root
+        if index_dir is None:
+            key = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()
+            index_dir = os.path.join(FACE_INDEX_DIR, key[:16])
+        self.dir = index_dir
+        self.manifest_path = os.path.join(self.dir, "manifest.json")
+        self.encodings_path = os.path.join(self.dir, "encodings.npy")
+        self.encoder = encoder
+        os.makedirs(self.dir, exist_ok=True)
+
+        # Relative path -> person, mtime, size and matrix row (None when the
+        # photo has no face)
+        self.files = {}
+        self.encodings = None
+        if os.path.exists(self.manifest_path) and os.path.exists(self.encodings_path):
+            with open(self.manifest_path) as f:
+                self.files = json.load(f)["files"]
+            self.encodings = np.load(self.encodings_path, mmap_mode="r+")
+        if self.encodings is None:
+            self._allocate(256)
+        self._build()
+
+    def __len__(self):
+        return len(self.people)
+
+    def scan(self):
+        # (relative path, person) for every reference photo
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.relpath(os.path.join(root, name), self.root)
+                parts = path.split(os.sep)
+                yield path, parts[0] if len(parts) > 1 else os.path.splitext(name)[0]
+
+    def update(self):
+        # Encode new and changed photos and drop deleted ones
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        used = {entry["row"] for entry in self.files.values()} - {None}
+        free = sorted(set(range(len(self.encodings))) - used, reverse=True)
+        for path, person in self.scan():
+            seen.add(path)
+            stat = os.stat(os.path.join(self.root, path))
+            entry = self.files.get(path)
+            if (
+                entry is not None
+                and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size
+                and entry["person"] == person
+            ):
+                counts["unchanged"] += 1
+                continue
+
+            encoding = self.encoder(os.path.join(self.root, path))
+            row = entry["row"] if entry is not None else None
+            if encoding is None:
+                if row is not None:
+                    free.append(row)
+                row = None
+                print(f"No face found in {path}")
+            else:
+                if row is None:
+                    if not free:
+                        capacity = len(self.encodings)
+                        self._allocate(2 * capacity)
+                        free = list(range(2 * capacity - 1, capacity - 1, -1))
+                    row = free.pop()
+                self.encodings[row] = encoding
+            self.files[path] = {
+                "person": person,
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "row": row,
+            }
+            counts["updated" if entry is not None else "added"] += 1
+
+        for path in set(self.files) - seen:
+            del self.files[path]
+            counts["removed"] += 1
+
+        self.flush()
+        self._build()
+        return counts
+
+    def flush(self):
+        self.encodings.flush()
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def match(self, encodings, tolerance=0.6):
+        # (name, distance) for each face encoding. All faces are compared
+        # with all photos in one matrix product, then each person scores
+        # the distance of their closest photo
+        encodings = np.asarray(encodings, dtype="float32").reshape(-1, ENCODING_SIZE)
+        if not len(encodings) or not len(self.people):
+            return [("Unknown", float("inf"))] * len(encodings)
+        squared = (
+            (encodings**2).sum(axis=1)[:, None]
+            + self._norms[None, :]
+            - 2 * encodings @ self._matrix.T
+        )
+        distances = np.sqrt(np.maximum(squared, 0))
+        per_person = np.minimum.reduceat(distances, self._starts, axis=1)
+        best = per_person.argmin(axis=1)
+        best_distances = per_person[np.arange(len(encodings)), best]
+        return [
+            (self.people[i] if d <= tolerance else "Unknown", float(d))
+            for i, d in zip(best, best_distances)
+        ]
+
+    def _build(self):
+        # Gather the rows in use, grouped by person, into one in-memory
+        # matrix for matching
+        entries = sorted(
+            (entry["person"], entry["row"])
+            for entry in self.files.values()
+            if entry["row"] is not None
+        )
+        persons = [person for person, _ in entries]
+        rows = np.array([row for _, row in entries], dtype="int64")
+        self._matrix = np.asarray(self.encodings[rows], dtype="float32")
+        self._norms = (self._matrix**2).sum(axis=1)
+        self.people, starts = np.unique(persons, return_index=True)
+        self.people = list(self.people)
+        self._starts = starts
+
+    def _allocate(self, capacity):
+        # Grow the memory-mapped matrix, keeping the rows already written
+        tmp_path = self.encodings_path + ".tmp"
+        encodings = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype="float32", shape=(capacity, ENCODING_SIZE)
+        )
+        if self.encodings is not None:
+            encodings[: len(self.encodings)] = self.encodings
+            del self.encodings
+        encodings.flush()
+        os.replace(tmp_path, self.encodings_path)
+        self.encodings = encodings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build or update the known-face index."
+    )
+    parser.add_argument("root", nargs="?", default="face_data")
+    args = parser.parse_args(argv)
+
+    gallery = FaceGallery(args.root)
+    counts = gallery.update()
+    print(
+        f"{len(gallery)} people: {counts['added']} added, "
+        f"{counts['updated']} updated, {counts['removed']} removed, "
+        f"{counts['unchanged']} unchanged"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+import argparse
+import glob
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from face_index import IMAGE_EXTENSIONS, FaceGallery
+
+
+class ImageSequence:
+    # A directory or glob of images read like a cv2.VideoCapture, so the
+    # pipeline can be run offline
+    def __init__(self, pattern):
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        self.paths = [
+            path
+            for path in sorted(glob.glob(pattern))
+            if path.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+        self.position = 0
+
+    def isOpened(self):
+        return bool(self.paths)
+
+    def read(self):
+        while self.position < len(self.paths):
+            frame = cv2.imread(self.paths[self.position])
+            self.position += 1
+            if frame is not None:
+                return True, frame
+        return False, None
+
+    def release(self):
+        pass
+
+
+def open_source(source):
+    # A device number, a video file, or a directory/glob of images
+    if isinstance(source, int) or str(source).isdigit():
+        return cv2.VideoCapture(int(source)), True
+    if os.path.isdir(source) or any(c in source for c in "*?["):
+        return ImageSequence(source), False
+    return cv2.VideoCapture(source), False
+
+
+class FrameGrabber:
+    # Reads frames on its own thread into a one-frame queue. Live sources
+    # replace the queued frame, so the consumer always gets the newest one
+    # and stale frames are dropped; offline sources are read without drops
+    def __init__(self, capture, live=True):
+        self.capture = capture
+        self.live = live
+        self.frames = queue.Queue(maxsize=1)
+        self.dropped = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        index = 0
+        while not self._stopped.is_set():
+            ok, frame = self.capture.read()
+            if not ok:
+                break
+            item = (index, time.perf_counter(), frame)
+            index += 1
+            if not self.live:
+                while not self._stopped.is_set():
+                    try:
+                        self.frames.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                continue
+            try:
+                self.frames.put_nowait(item)
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                self.frames.put_nowait(item)
+        # End of stream
+        self._put_end()
+
+    def _put_end(self):
+        while True:
+            try:
+                self.frames.put(None, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stopped.is_set():
+                    return
+
+    def read(self):
+        # (index, capture time, frame), or None once the source is exhausted
+        return self.frames.get()
+
+    def stop(self):
+        self._stopped.set()
+        # Unblock the reader if it is waiting on a full queue
+        try:
+            self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join()
+        self.capture.release()
+
+
+class FaceDetector:
+    # Finds and names faces on a downscaled copy of the frame and returns
+    # boxes in full-resolution coordinates
+    def __init__(self, gallery, scale=0.25, tolerance=0.6):
+        import face_recognition
+
+        self.face_recognition = face_recognition
+        self.gallery = gallery
+        self.scale = scale
+        self.tolerance = tolerance
+
+    def __call__(self, frame):
+        small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale)
+        # OpenCV frames are BGR, face_recognition expects RGB
+        rgb = np.ascontiguousarray(small[:, :, ::-1])
+        locations = self.face_recognition.face_locations(rgb)
+        encodings = self.face_recognition.face_encodings(rgb, locations)
+
+        # Every face in the frame is matched against the gallery at once
+        matches = self.gallery.match(encodings, self.tolerance)
+        faces = []
+        for (top, right, bottom, left), (name, _) in zip(locations, matches):
+            box = tuple(int(v / self.scale) for v in (left, top, right, bottom))
+            faces.append((box, name))
+        return faces
+
+
+class AsyncDetector:
+    # Runs the detector on a background thread. submit() never blocks: a
+    # frame arriving while a detection is running is skipped
+    def __init__(self, detector):
+        self.detector = detector
+        self.latency = 0.0
+        self._frames = queue.Queue(maxsize=1)
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, index, frame):
+        try:
+            self._frames.put_nowait((index, frame))
+            return True
+        except queue.Full:
+            return False
+
+    def results(self):
+        # Every (frame index, faces) finished since the last call
+        finished = []
+        while True:
+            try:
+                finished.append(self._results.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def wait(self):
+        # Block until the queued detection, if any, has finished
+        self._frames.join()
+
+    def _run(self):
+        while True:
+            item = self._frames.get()
+            if item is None:
+                self._frames.task_done()
+                return
+            index, frame = item
+            started = time.perf_counter()
+            try:
+                faces = self.detector(frame)
+            except Exception as e:
+                print(f"Detection failed: {e}")
+                faces = []
+            self.latency = time.perf_counter() - started
+            self._results.put((index, faces))
+            self._frames.task_done()
+
+    def stop(self):
+        self._frames.put(None)
+        self._thread.join()
+
+
+def iou(a, b):
+    # Intersection over union of two (left, top, right, bottom) boxes
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1])
+    union -= intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class Track:
+    def __init__(self, track_id, box, name):
+        self.track_id = track_id
+        self.box = box
+        self.name = name
+        self.misses = 0
+
+
+class IoUTracker:
+    # Keeps boxes and names on screen between detections. Each detection
+    # updates the track it overlaps most; tracks missed by several
+    # detections in a row are dropped
+    def __init__(self, threshold=0.3, max_misses=2):
+        self.threshold = threshold
+        self.max_misses = max_misses
+        self.tracks = []
+        self._next_id = 0
+
+    def update(self, faces):
+        unmatched = list(self.tracks)
+        for box, name in faces:
+            best = max(unmatched, key=lambda t: iou(t.box, box), default=None)
+            if best is not None and iou(best.box, box) >= self.threshold:
+                unmatched.remove(best)
+                best.box = box
+                best.misses = 0
+                # Keep a known name through a frame where the match failed
+                if name != "Unknown" or best.name == "Unknown":
+                    best.name = name
+            else:
+                self.tracks.append(Track(self._next_id, box, name))
+                self._next_id += 1
+        for track in unmatched:
+            track.misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        return self.tracks
+
+
+class RateMeter:
+    # Frames per second and capture-to-display latency, smoothed
+    def __init__(self, smoothing=0.9):
+        self.smoothing = smoothing
+        self.fps = 0.0
+        self.latency = 0.0
+        self._last = None
+
+    def tick(self, captured):
+        now = time.perf_counter()
+        if self._last is not None and now > self._last:
+            self.fps = self._smooth(self.fps, 1 / (now - self._last))
+        self.latency = self._smooth(self.latency, now - captured)
+        self._last = now
+
+    def _smooth(self, average, value):
+        if not average:
+            return value
+        return self.smoothing * average + (1 - self.smoothing) * value
+
+
+def draw(frame, tracks, meter, detection_latency):
+    for track in tracks:
+        left, top, right, bottom = track.box
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+        font = cv2.FONT_HERSHEY_DUPLEX
+        cv2.putText(
+            frame, track.name, (left + 6, bottom - 6), font, 0.5, (255, 255, 255), 1
+        )
+    status = (
+        f"{meter.fps:.1f} FPS  latency {meter.latency * 1000:.0f} ms  "
+        f"detect {detection_latency * 1000:.0f} ms"
+    )
+    cv2.putText(frame, status, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+
+
+def run(
+    source=0,
+    detector=None,
+    detect_every=5,
+    headless=False,
+    max_frames=None,
+    output=None,
+):
+    # Capture, detect every Nth frame in the background, track in between,
+    # and display or write the annotated frames. Returns summary stats
+    capture, live = open_source(source)
+    if not capture.isOpened():
+        raise RuntimeError(f"Could not open video source {source!r}")
+    grabber = FrameGrabber(capture, live=live)
+    detection = AsyncDetector(detector)
+    tracker = IoUTracker()
+    meter = RateMeter()
+    writer = None
+    frames = 0
+    skipped = 0
+    started = time.perf_counter()
+    try:
+        while max_frames is None or frames < max_frames:
+            item = grabber.read()
+            if item is None:
+                break
+            index, captured, frame = item
+
+            if index % detect_every == 0:
+                # Offline sources are not real time, so wait for each
+                # detection to keep results reproducible
+                if not detection.submit(index, frame.copy()):
+                    skipped += 1
+                if not live:
+                    detection.wait()
+            for _, faces in detection.results():
+                tracker.update(faces)
+
+            meter.tick(captured)
+            draw(frame, tracker.tracks, meter, detection.latency)
+            frames += 1
+
+            if output:
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = cv2.VideoWriter(
+                        output, cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height)
+                    )
+                writer.write(frame)
+            if not headless:
+                cv2.imshow("Video", frame)
+                # Exit the loop if 'q' is pressed
+                if cv2.waitKey(1) & 0xFF == ord("q"):
+                    break
+    finally:
+        grabber.stop()
+        detection.stop()
+        if writer is not None:
+            writer.release()
+        if not headless:
+            cv2.destroyAllWindows()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "frames": frames,
+        "fps": frames / elapsed if elapsed else 0.0,
+        "latency_ms": meter.latency * 1000,
+        "detection_ms": detection.latency * 1000,
+        "dropped_frames": grabber.dropped,
+        "skipped_detections": skipped,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Real-time face recognition.")
+    parser.add_argument(
+        "--source",
+        default="0",
+        help="camera number, video file, or directory/glob of images",
+    )
+    parser.add_argument(
+        "--faces", default="face_data", help="known faces, one folder per person"
+    )
+    parser.add_argument(
+        "--detect-every", type=int, default=5, help="run detection every Nth frame"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=0.25, help="downscale factor for detection"
+    )
+    parser.add_argument("--headless", action="store_true", help="no display window")
+    parser.add_argument("--max-frames", type=int)
+    parser.add_argument("--output", help="write the annotated video here")
+    args = parser.parse_args(argv)
+
+    # Only photos added or changed since the last run are encoded
+    gallery = FaceGallery(args.faces)
+    gallery.update()
+    print(f"{len(gallery)} known people")
+    detector = FaceDetector(gallery, scale=args.scale)
+    stats = run(
+        args.source,
+        detector,
+        detect_every=args.detect_every,
+        headless=args.headless,
+        max_frames=args.max_frames,
+        output=args.output,
+    )
+    print(
+        f"{stats['frames']} frames at {stats['fps']:.1f} FPS, "
+        f"latency {stats['latency_ms']:.0f} ms, "
+        f"detection {stats['detection_ms']:.0f} ms, "
+        f"{stats['dropped_frames']} frames dropped"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BACKBONES = ["VGG19", "ResNet50", "InceptionV3", "MobileNetV2"]
+LABELS = ["Ripe", "Unripe", "Semi Ripe", "Overripe"]
+
+# Metrics compared against the baseline, and whether higher is better
+METRICS = {
+    "startup.total_sec": False,
+    "inference.latency_ms.p50": False,
+    "inference.latency_ms.p99": False,
+    "inference.throughput": True,
+    "inference.peak_rss_mb": False,
+    "training.images_per_sec": True,
+    "training.peak_rss_mb": False,
+}
+
+# Runs in a fresh interpreter so import and model load costs are real
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import prediction
+imported = time.perf_counter()
+classifier = prediction.load_classifier(
+    pretrained=sys.argv[1] == "", model_path=sys.argv[1] or None,
+    backbone=sys.argv[2] or None,
+)
+loaded = time.perf_counter()
+classifier.classify(sys.argv[3])
+predicted = time.perf_counter()
+print(json.dumps({
+    "import_sec": imported - started,
+    "load_sec": loaded - imported,
+    "first_prediction_sec": predicted - loaded,
+    "total_sec": predicted - started,
+}))
+"""
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+def synthetic_images(directory, count, size=(320, 240), seed=0):
+    # Random noise JPEGs, so no dataset download is needed
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        path = os.path.join(directory, f"synthetic_{i}.jpg")
+        Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+
+def synthetic_dataset(root, per_class, seed=0):
+    # train/ and validation/ folders laid out the way the trainer expects
+    for split, count in (("train", per_class), ("validation", max(1, per_class // 4))):
+        for i, label in enumerate(LABELS):
+            synthetic_images(os.path.join(root, split, label), count, seed=seed + i)
+    return root
+
+
+def run_task(task, *args, cwd=ROOT, env=None):
+    # Run one measurement in a separate process so peak RSS and cold-start
+    # costs are isolated per backbone
+    output = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmark.py"), "--task", task]
+        + [str(arg) for arg in args],
+        cwd=cwd,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_startup(image_path, model_path=None, backbone=None, env=None):
+    # Cold start to first prediction in a separate process
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            STARTUP_SCRIPT,
+            model_path or "",
+            backbone or "",
+            image_path,
+        ],
+        cwd=ROOT,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def startup_benchmark(image_path, model_path=None, backbone=None, runs=3):
+    results = {}
+    if model_path is None:
+        # The first start with an empty model cache pays for building the
+        # pretrained model; later starts load it from the cache
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            env.setdefault(
+                "KERAS_HOME", os.path.join(os.path.expanduser("~"), ".keras")
+            )
+            results["uncached"] = measure_startup(image_path, None, backbone, env)
+            results["cached"] = measure_startup(image_path, None, backbone, env)
+
+    runs = [measure_startup(image_path, model_path, backbone) for _ in range(runs)]
+    results.update(
+        {name: float(np.median([run[name] for run in runs])) for name in runs[0]}
+    )
+    return results
+
+
+def inference_task(model_path, image_dir, batch_sizes, latency_runs):
+    # Single-image latency percentiles and batched throughput, in-process
+    from prediction import load_classifier
+
+    paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir))
+    classifier = load_classifier(pretrained=False, model_path=model_path)
+    classifier.warmup()
+    classifier.classify(paths[0])
+
+    latencies = []
+    for i in range(latency_runs):
+        started = time.perf_counter()
+        classifier.classify(paths[i % len(paths)])
+        latencies.append((time.perf_counter() - started) * 1000)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+
+    throughput = {}
+    for batch_size in batch_sizes:
+        # One untimed pass so each batch shape is traced before timing
+        classifier.classify_batch(paths[:batch_size], batch_size=batch_size)
+        started = time.perf_counter()
+        classifier.classify_batch(paths, batch_size=batch_size)
+        throughput[str(batch_size)] = len(paths) / (time.perf_counter() - started)
+
+    return {
+        "backbone": classifier.backbone,
+        "latency_ms": {"p50": p50, "p90": p90, "p99": p99},
+        "throughput": throughput,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def training_task(backbone, dataset_dir, model_path, steps, batch_size):
+    # Training images/sec for the end-to-end trainer on synthetic data, with
+    # random weights so no ImageNet download is needed. The trained model is
+    # saved for the inference measurements
+    import tensorflow as tf
+
+    # The trainer imports its sibling modules by name
+    sys.path.insert(0, os.path.join(ROOT, "trainer"))
+    from trainer import ImageClassifierTrainer, TrainingConfig
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.started = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.elapsed = time.perf_counter() - self.started
+
+    trainer = ImageClassifierTrainer(
+        backbone,
+        train_dir=os.path.join(dataset_dir, "train"),
+        val_dir=os.path.join(dataset_dir, "validation"),
+        weights=None,
+    )
+    timer = EpochTimer()
+    # The first epoch pays for graph tracing and filling the data cache, so
+    # only the second one is timed
+    config = TrainingConfig(
+        epochs=2,
+        batch_size=batch_size,
+        steps_per_epoch=steps,
+        validation_steps=1,
+        early_stopping_patience=None,
+        checkpoint_path=None,
+    )
+    trainer.train(config, callbacks=[timer], verbose=0)
+    trainer.save_model(model_path)
+    return {
+        "images_per_sec": steps * batch_size / timer.elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and value is not None:
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    # Flag every tracked metric that got worse by more than tolerance
+    regressions = []
+    current = flatten(results["backbones"])
+    previous = flatten(baseline["backbones"])
+    for name, value in current.items():
+        metric = name.split(".", 1)[1]
+        tracked = [m for m in METRICS if metric == m or metric.startswith(m + ".")]
+        if not tracked or name not in previous or not previous[name]:
+            continue
+        higher_is_better = METRICS[tracked[0]]
+        change = (value - previous[name]) / previous[name]
+        if (higher_is_better and change < -tolerance) or (
+            not higher_is_better and change > tolerance
+        ):
+            regressions.append(
+                {"metric": name, "baseline": previous[name], "current": value}
+            )
+    return regressions
+
+
+def run_suite(args):
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "backbones": {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        image_dir = os.path.join(workdir, "images")
+        synthetic_images(image_dir, args.images)
+        dataset_dir = synthetic_dataset(
+            os.path.join(workdir, "dataset"), max(1, args.batch_size // 2)
+        )
+
+        for backbone in args.backbones:
+            print(f"Benchmarking {backbone}", file=sys.stderr)
+            model_path = os.path.join(workdir, f"{backbone}.h5")
+            training = run_task(
+                "training",
+                backbone,
+                dataset_dir,
+                model_path,
+                args.train_steps,
+                args.batch_size,
+                cwd=os.path.join(ROOT, "trainer"),
+            )
+            image_path = os.path.join(image_dir, "synthetic_0.jpg")
+            startup = startup_benchmark(image_path, model_path, runs=args.runs)
+            inference = run_task(
+                "inference",
+                model_path,
+                image_dir,
+                ",".join(str(b) for b in args.batch_sizes),
+                args.latency_runs,
+            )
+            results["backbones"][backbone] = {
+                "startup": startup,
+                "inference": inference,
+                "training": training,
+            }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark inference and training throughput."
+    )
+    parser.add_argument("--backbones", nargs="+", default=BACKBONES, choices=BACKBONES)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--images", type=int, default=64, help="synthetic images")
+    parser.add_argument("--latency-runs", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=3, help="cold-start runs")
+    parser.add_argument("--train-steps", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16, help="training batch")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.15, help="allowed relative slowdown"
+    )
+    parser.add_argument(
+        "--pretrained-startup",
+        action="store_true",
+        help="only measure pretrained cold start (needs the ImageNet weights)",
+    )
+    parser.add_argument("--task", help=argparse.SUPPRESS)
+    args, extra = parser.parse_known_args(argv)
+
+    # Internal: a single measurement run in its own process
+    if args.task == "training":
+        backbone, dataset_dir, model_path, steps, batch_size = extra
+        print(
+            json.dumps(
+                training_task(
+                    backbone, dataset_dir, model_path, int(steps), int(batch_size)
+                )
+            )
+        )
+        return 0
+    if args.task == "inference":
+        model_path, image_dir, batch_sizes, latency_runs = extra
+        batch_sizes = [int(b) for b in batch_sizes.split(",")]
+        print(
+            json.dumps(
+                inference_task(model_path, image_dir, batch_sizes, int(latency_runs))
+            )
+        )
+        return 0
+    if extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    if args.pretrained_startup:
+        with tempfile.TemporaryDirectory() as directory:
+            image_path = synthetic_images(directory, 1)[0]
+            results = {
+                "backbones": {
+                    backbone: {
+                        "startup": startup_benchmark(
+                            image_path, backbone=backbone, runs=args.runs
+                        )
+                    }
+                    for backbone in args.backbones
+                }
+            }
+    else:
+        results = run_suite(args)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['metric']}: "
+                f"{regression['baseline']:.4g} -> {regression['current']:.4g}",
+                file=sys.stderr,
+            )
+        if regressions:
+            return 1
+        print("No regressions against the baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 import sys
-import re
+from array import array
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -11,16 +11,26 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QFileDialog,
     QComboBox,
-    QPlainTextEdit,
     QToolBar,
     QToolButton,
     QRadioButton,
     QMenu,
+    QProgressBar,
+    QCheckBox,
 )
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QTextCursor
-from prediction import VGG19CoffeeClassifier
+from PyQt5.QtCore import Qt, QThread
+from trainer.console import Console
+from trainer.image_table import (
+    ImageTableModel,
+    ThumbnailCache,
+    configure_view,
+    scaled_pixmap,
+)
+from prediction import BACKBONES, LABEL_DICT
+from prediction_cache import PredictionCache
+from prediction_worker import PredictionWorker
+from result_store import ResultStore
+from profiling import profiler
 
 
 class MainWindow(QMainWindow):
@@ -37,13 +47,26 @@ class MainWindow(QMainWindow):
             | Qt.WindowCloseButtonHint
         )
 
-        # Create a data model for the table
-        self.model = QStandardItemModel(0, 2, self)
-        self.model.setHorizontalHeaderLabels(["File Name", "Ripeness", "Accuracy"])
+        # Create a data model for the table, with thumbnails loaded in the
+        # background as rows scroll into view
+        self.thumbnails = ThumbnailCache(parent=self)
+        self.model = ImageTableModel(
+            LABEL_DICT.values(),
+            ["File Name", "Ripeness", "Accuracy"],
+            thumbnails=self.thumbnails,
+            parent=self,
+        )
         self.table_view.setModel(self.model)
+        configure_view(self.table_view)
 
         self.pre_trained = True
         self.model_path = None
+        self.prediction_thread = None
+        self.prediction_worker = None
+        self.pending_ids = array("q")
+        self.prediction_cache = PredictionCache()
+        # Records of the last run, spilled to a temporary file when large
+        self.results = ResultStore()
 
         # Create an image preview widget
         self.image_label = QLabel(self)
@@ -56,19 +79,42 @@ class MainWindow(QMainWindow):
         self.button1.clicked.connect(self.add_images)
         self.button2.clicked.connect(self.predict_images)
 
+        # Create the prediction progress bar and cancel button
+        self.progress_bar = QProgressBar(self)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_prediction)
+
         # Create radio buttons
         self.radio_button_1 = QRadioButton("Pretrained Models")
         self.radio_button_2 = QRadioButton("Custom Models")
         self.radio_button_1.toggled.connect(self.radio_button_toggled)
         self.radio_button_2.toggled.connect(self.radio_button_toggled)
 
+        # Create the backbone selector. Auto detects the backbone of custom
+        # models and uses VGG19 for the pretrained one
+        self.backbone_combo = QComboBox(self)
+        self.backbone_combo.addItems(["Auto"] + list(BACKBONES))
+
+        # Per-stage timings of the next predictions, reported in the log
+        self.profile_checkbox = QCheckBox("Profile", self)
+        self.profile_checkbox.setChecked(profiler.enabled)
+        self.profile_checkbox.toggled.connect(self.profile_toggled)
+        self.export_profile_button = QPushButton("Export Profile", self)
+        self.export_profile_button.clicked.connect(self.export_profile)
+
         # Create a horizontal layout to hold the image and buttons
         image_layout = QVBoxLayout()
         image_layout.addWidget(self.image_label)
         image_layout.addWidget(self.button1)
         image_layout.addWidget(self.button2)
+        image_layout.addWidget(self.progress_bar)
+        image_layout.addWidget(self.cancel_button)
         image_layout.addWidget(self.radio_button_1)
         image_layout.addWidget(self.radio_button_2)
+        image_layout.addWidget(self.backbone_combo)
+        image_layout.addWidget(self.profile_checkbox)
+        image_layout.addWidget(self.export_profile_button)
 
         # Create a horizontal layout to hold the table and image layouts
         table_widget = QWidget(self)
@@ -82,11 +128,9 @@ class MainWindow(QMainWindow):
         # Connect the clicked signal of the table view to a custom slot
         self.table_view.clicked.connect(self.handle_table_click)
 
-        self.text_edit = QPlainTextEdit()
-        # Redirect terminal output to the log
-        sys.stdout = self
-        # Initialize the output buffer
-        self.buffer = ""
+        # Buffered log of print() output and log records, safe to write to
+        # from worker threads
+        self.text_edit = Console(self)
         image_layout.addWidget(self.text_edit)
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
@@ -104,24 +148,6 @@ class MainWindow(QMainWindow):
         if index.isValid():
             self.table_view.model().removeRow(index.row())
 
-    def write(self, message):
-        # Append the message to the output buffer
-        self.buffer += message
-
-        # If a newline character is encountered, flush the buffer to the log
-        if "\n" in message:
-            lines = self.buffer.split("\n")
-            for line in lines[:-1]:
-                # Write each line to the log
-                line = re.sub(r"[^\x20-\x7E]+", "", line)
-                self.text_edit.moveCursor(QTextCursor.End)
-                self.text_edit.insertPlainText(line + "\n")
-            # Clear the buffer
-            self.buffer = lines[-1]
-
-    def flush(self):
-        pass
-
     def radio_button_toggled(self):
         if self.radio_button_2.isChecked():
             if self.model_path is None:
@@ -135,13 +161,11 @@ class MainWindow(QMainWindow):
             print("No option selected")
 
     def show_image(self, filename):
-        pixmap = QPixmap(filename)
-        pixmap = pixmap.scaledToHeight(200)
-        self.image_label.setPixmap(pixmap)
+        self.image_label.setPixmap(scaled_pixmap(filename, 200))
 
     def add_model(self):
         files, _ = QFileDialog.getOpenFileName(
-            self, "Open file", "", "Custom Model (*.h5)"
+            self, "Open file", "", "Custom Model (*.h5 *.tflite)"
         )
 
         self.model_path = files
@@ -150,29 +174,110 @@ class MainWindow(QMainWindow):
         files, _ = QFileDialog.getOpenFileNames(
             self, "Open file", "", "Images (*.png *.xpm *.jpg *.bmp *.gif)"
         )
-        for i, file in enumerate(files):
-            self.show_image(file)
-            row = self.model.rowCount()
-            self.model.insertRow(row)
-            for column in range(1):
-                self.model.setItem(row, 0, QStandardItem(file))
+        if files:
+            self.model.add_paths(files)
+            self.show_image(files[-1])
+
+    def profile_toggled(self, checked):
+        profiler.enabled = checked
+
+    def export_profile(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Export profile", "profile.json", "JSON (*.json)"
+        )
+        if path:
+            profiler.export(path)
+            print(f"Profile written to {path}")
 
     def handle_table_click(self, index):
         # Get the selected row and column index
         index = self.table_view.selectedIndexes()[0]
         row = index.row()
-        self.show_image(self.model.item(row, 0).text())
+        self.show_image(self.model.path(row))
 
     def predict_images(self):
-        vgg_coffee = VGG19CoffeeClassifier(
-            pretrained=self.pre_trained, model_path=self.model_path
+        if self.prediction_thread is not None:
+            return
+
+        # Track rows by id so deleting rows mid-run is safe
+        self.pending_ids = self.model.ids[:]
+        files = list(self.model.paths)
+        backbone = self.backbone_combo.currentText()
+        profiler.reset()
+        self.results.close()
+
+        # Run model loading and inference on a background thread
+        self.prediction_thread = QThread(self)
+        self.prediction_worker = PredictionWorker(
+            files,
+            pretrained=self.pre_trained,
+            model_path=self.model_path,
+            backbone=None if backbone == "Auto" else backbone,
+            cache=self.prediction_cache,
         )
-        for i in range(self.model.rowCount()):
-            file = self.model.item(i, 0).text()
-            print(vgg_coffee.classify(file))
-            data = vgg_coffee.classify(file)
-            self.model.setItem(i, 1, QStandardItem(data["label"]))
-            self.model.setItem(i, 2, QStandardItem(str(data["accuracy"])))
+        self.prediction_worker.moveToThread(self.prediction_thread)
+        self.prediction_thread.started.connect(self.prediction_worker.run)
+        self.prediction_worker.records.connect(self.prediction_records)
+        self.prediction_worker.progress.connect(self.prediction_progress)
+        self.prediction_worker.failed.connect(self.prediction_failed)
+        self.prediction_worker.finished.connect(self.prediction_finished)
+
+        self.button2.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.prediction_thread.start()
+
+    def cancel_prediction(self):
+        if self.prediction_worker is not None:
+            self.prediction_worker.cancel()
+            self.cancel_button.setEnabled(False)
+
+    def prediction_records(self, records):
+        # Keep the compact records, spilling them to disk past the memory
+        # budget, and show the batch in the table
+        with profiler.stage("table", len(records)):
+            self.results.append(records)
+            current_rows = self.model.rows_for_ids(
+                self.pending_ids[index] for index in records["index"]
+            )
+            rows, label_ids, scores = [], [], []
+            for row, record in zip(current_rows, records):
+                if row is not None:
+                    rows.append(row)
+                    label_ids.append(record["class_id"])
+                    scores.append(record["probabilities"][record["class_id"]])
+            self.model.set_results(rows, label_ids, scores)
+
+    def prediction_progress(self, done, total):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+
+    def prediction_failed(self, message):
+        print(f"Prediction failed: {message}")
+
+    def prediction_finished(self):
+        self.prediction_thread.quit()
+        self.prediction_thread.wait()
+        self.prediction_worker.deleteLater()
+        self.prediction_thread.deleteLater()
+        self.prediction_thread = None
+        self.prediction_worker = None
+        self.pending_ids = array("q")
+        if len(self.results):
+            counts = self.results.class_counts(len(LABEL_DICT))
+            print(
+                f"{len(self.results)} images: "
+                + ", ".join(
+                    f"{LABEL_DICT[i]} {count}" for i, count in enumerate(counts)
+                )
+            )
+        self.button2.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        if profiler.enabled:
+            print(profiler.report())
+
+    def closeEvent(self, event):
+        self.results.close()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from prediction import load_classifier
+
+log = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    def __init__(self, max_models=2, max_bytes=2 * 1024**3):
+        # Keep at most max_models classifiers, and no more than max_bytes of
+        # weights, resident at once
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _key(self, pretrained, model_path, backbone):
+        # Custom models are keyed by their file modification time so a
+        # retrained .h5 is picked up instead of the stale cached copy
+        if pretrained:
+            return (True, backbone or "VGG19", None, None)
+        model_path = os.path.abspath(model_path)
+        return (False, backbone, model_path, os.path.getmtime(model_path))
+
+    def get(self, pretrained=True, model_path=None, backbone=None):
+        key = self._key(pretrained, model_path, backbone)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            # Drop older versions of the same model file
+            for stale in [k for k in self._models if k[:3] == key[:3]]:
+                log.info("Evicting stale model %s", stale[2])
+                del self._models[stale]
+
+            if pretrained:
+                log.info("Loading pretrained %s model", key[1])
+            else:
+                log.info("Loading %s", model_path)
+            classifier = load_classifier(
+                pretrained=pretrained, model_path=model_path, backbone=backbone
+            )
+            self._models[key] = classifier
+            self._enforce_limits()
+            return classifier
+
+    def warmup(self, pretrained=True, model_path=None, backbone=None):
+        # Load the model if needed and push a dummy batch through it
+        classifier = self.get(
+            pretrained=pretrained, model_path=model_path, backbone=backbone
+        )
+        classifier.warmup()
+        return classifier
+
+    def evict(self, pretrained=None, model_path=None):
+        # Evict a single model, or every resident model when called without
+        # arguments. Returns the number of models evicted
+        with self._lock:
+            if pretrained is None and model_path is None:
+                evicted = len(self._models)
+                self._models.clear()
+                return evicted
+
+            if model_path is not None:
+                model_path = os.path.abspath(model_path)
+            matches = [
+                key
+                for key in self._models
+                if (pretrained is None or key[0] == pretrained)
+                and (model_path is None or key[2] == model_path)
+            ]
+            for key in matches:
+                del self._models[key]
+            return len(matches)
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(c.memory_bytes() for c in self._models.values())
+
+    def _enforce_limits(self):
+        # Evict the least recently used models, always keeping the newest one
+        while len(self._models) > 1 and (
+            len(self._models) > self.max_models or self.memory_bytes() > self.max_bytes
+        ):
+            key, _ = self._models.popitem(last=False)
+            log.info("Evicting model %s", key[2] or key[1])
+
+
+# Process-wide registry shared by the GUI and any other callers
+registry = ModelRegistry()
@@ -0,0 +1,253 @@
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from prediction import read_image
+
+# How often the parent checks that every child process is still alive
+POLL_SEC = 1.0
+
+
+def thread_budget(processes, decoders, threads=None):
+    # Split the cores between decoder processes and inference processes so
+    # TensorFlow pools do not oversubscribe the machine
+    if threads:
+        return threads
+    return max(1, ((os.cpu_count() or 1) - decoders) // processes)
+
+
+def inference_worker(
+    worker_id, model_args, threads, pin, setup, ready, free_slots, events
+):
+    # Holds one model with a fixed thread budget and runs the batches the
+    # decoders leave in shared memory, writing probabilities into the
+    # shared result array
+    try:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        if pin and hasattr(os, "sched_setaffinity"):
+            cores = os.cpu_count() or 1
+            first = worker_id * threads
+            os.sched_setaffinity(0, {(first + i) % cores for i in range(threads)})
+
+        from prediction import load_classifier
+
+        if model_args.get("model_path", "").endswith(".tflite"):
+            model_args = dict(model_args, num_threads=threads)
+        classifier = load_classifier(**model_args)
+        classifier.warmup()
+        num_classes = classifier.predict_batch(
+            np.zeros((1, classifier.img_height, classifier.img_width, 3), "float32")
+        ).shape[-1]
+        # Handshake: the parent sizes the shared memory from the first reply
+        events.put(
+            (
+                "ready",
+                worker_id,
+                int(classifier.img_height),
+                int(classifier.img_width),
+                int(num_classes),
+            )
+        )
+
+        # Blocks are only unlinked by the parent, which shares its resource
+        # tracker with every spawned child
+        config = setup.get()
+        if config is None:
+            return
+        slots_block = shared_memory.SharedMemory(name=config["slots"])
+        results_block = shared_memory.SharedMemory(name=config["results"])
+        slots = np.ndarray(config["slots_shape"], "float32", slots_block.buf)
+        results = np.ndarray(config["results_shape"], "float32", results_block.buf)
+        batch = None
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                slot, start, count, failed = item
+                batch = classifier.preprocess_batch(slots[slot, :count])
+                preds = classifier.predict_batch(batch)
+                results[start : start + count] = preds
+                for offset in failed:
+                    results[start + offset] = np.nan
+                free_slots.put(slot)
+                events.put(("done", start, count, failed))
+        finally:
+            # Views must be released before the blocks can be closed
+            slots = results = batch = None
+            slots_block.close()
+            results_block.close()
+    except Exception as e:
+        events.put(("error", f"inference worker {worker_id}: {e}"))
+
+
+def decode_worker(config, tasks, ready, free_slots, events):
+    # Decodes image shards straight into free shared memory slots; only the
+    # slot number crosses the process boundary, never the pixels. Images
+    # that fail to decode are zeroed and reported with the batch
+    slots_block = shared_memory.SharedMemory(name=config["slots"])
+    slots = np.ndarray(config["slots_shape"], "float32", slots_block.buf)
+    height, width = config["slots_shape"][2:4]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            start, paths = task
+            slot = free_slots.get()
+            failed = {}
+            for i, path in enumerate(paths):
+                try:
+                    read_image(path, height, width, out=slots[slot, i])
+                except Exception as e:
+                    slots[slot, i] = 0
+                    failed[i] = str(e)
+            ready.put((slot, start, len(paths), failed))
+    finally:
+        slots = None
+        slots_block.close()
+
+
+def parallel_predictions(
+    image_paths,
+    pretrained=True,
+    model_path=None,
+    backbone=None,
+    processes=2,
+    threads=None,
+    decoders=None,
+    batch_size=32,
+    pin=False,
+    errors=None,
+):
+    # Score images with several model processes at once and yield
+    # (start, probabilities) in input order, like iter_predictions,
+    # including its handling of unreadable images through errors
+    image_paths = list(image_paths)
+    if not image_paths:
+        return
+    decoders = decoders or processes
+    threads = thread_budget(processes, decoders, threads)
+    model_args = {"pretrained": pretrained, "backbone": backbone}
+    if model_path:
+        model_args["model_path"] = model_path
+
+    # Spawned children start with a clean interpreter, so each can set its
+    # own TensorFlow thread pools before importing it
+    context = multiprocessing.get_context("spawn")
+    setup, tasks, ready, free_slots, events = (context.Queue() for _ in range(5))
+    children = [
+        context.Process(
+            target=inference_worker,
+            args=(i, model_args, threads, pin, setup, ready, free_slots, events),
+            daemon=True,
+        )
+        for i in range(processes)
+    ]
+    blocks = []
+    results = None
+    try:
+        for child in children:
+            child.start()
+
+        # Wait for every model to load and agree on the input size
+        shapes = set()
+        for _ in range(processes):
+            event = wait_for_event(events, children)
+            shapes.add(event[2:])
+        if len(shapes) != 1:
+            raise RuntimeError(f"Workers loaded models of different sizes: {shapes}")
+        height, width, num_classes = shapes.pop()
+
+        # Two slots per model process keep every model busy while the
+        # decoders fill the next batches
+        num_slots = 2 * processes
+        slots_shape = (num_slots, batch_size, height, width, 3)
+        results_shape = (len(image_paths), num_classes)
+        slots_block = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(slots_shape)) * 4
+        )
+        blocks.append(slots_block)
+        results_block = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(results_shape)) * 4
+        )
+        blocks.append(results_block)
+        results = np.ndarray(results_shape, "float32", results_block.buf)
+
+        config = {
+            "slots": slots_block.name,
+            "slots_shape": slots_shape,
+            "results": results_block.name,
+            "results_shape": results_shape,
+        }
+        for _ in range(processes):
+            setup.put(config)
+        for slot in range(num_slots):
+            free_slots.put(slot)
+        for start in range(0, len(image_paths), batch_size):
+            tasks.put((start, image_paths[start : start + batch_size]))
+        for _ in range(decoders):
+            tasks.put(None)
+        decoder_children = [
+            context.Process(
+                target=decode_worker,
+                args=(config, tasks, ready, free_slots, events),
+                daemon=True,
+            )
+            for _ in range(decoders)
+        ]
+        children.extend(decoder_children)
+        for child in decoder_children:
+            child.start()
+
+        # Batches finish out of order; yield each one once every batch
+        # before it has been yielded
+        finished = {}
+        position = 0
+        while position < len(image_paths):
+            _, start, count, failed = wait_for_event(events, children)
+            if failed and errors is None:
+                raise RuntimeError(next(iter(failed.values())))
+            if failed:
+                errors.update(
+                    {start + offset: message for offset, message in failed.items()}
+                )
+            finished[start] = count
+            while position in finished:
+                count = finished.pop(position)
+                yield position, results[position : position + count].copy()
+                position += count
+
+        for _ in range(processes):
+            ready.put(None)
+        for child in children:
+            child.join()
+    finally:
+        results = None
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def wait_for_event(events, children):
+    # Next message from the children, failing if one of them crashed or
+    # reported an error
+    while True:
+        try:
+            event = events.get(timeout=POLL_SEC)
+        except queue.Empty:
+            dead = [child for child in children if child.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"Worker process exited with {dead[0].exitcode}")
+            continue
+        if event[0] == "error":
+            raise RuntimeError(event[1])
+        return event
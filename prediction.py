@@ -1,65 +1,430 @@
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import threading
+
 import numpy as np
-import keras.utils as image
-from keras.applications.vgg19 import preprocess_input, decode_predictions
-from keras.models import Model
-from keras.models import load_model
-from keras.layers import Dense, GlobalAveragePooling2D
-from keras.optimizers import SGD
-from keras.applications.vgg19 import VGG19
+from PIL import Image
 
+from prefetch import ImagePrefetcher
+from profiling import profiler
+
+log = logging.getLogger(__name__)
+
+# Keras/TensorFlow are imported on first use rather than at import time, so
+# the GUI can show its window before paying for them
+
+# Assembled pretrained models are cached here so later starts skip the build
+MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "abstergo", "models")
+
+# Class index to label, shared by every classifier
+LABEL_DICT = {0: "Unripe", 1: "Semi-ripe", 2: "Ripe", 3: "Overripe"}
+
+# Supported backbones: keras.applications module and default input size
+BACKBONES = {
+    "VGG19": ("vgg19", 224),
+    "ResNet50": ("resnet50", 224),
+    "InceptionV3": ("inception_v3", 299),
+    "MobileNetV2": ("mobilenet_v2", 224),
+}
+
+# Input preprocessing each backbone was trained with, as in
+# keras.applications: "caffe" is BGR minus the ImageNet channel means, "tf"
+# scales pixels to [-1, 1]
+PREPROCESS_MODES = {
+    "VGG19": "caffe",
+    "ResNet50": "caffe",
+    "InceptionV3": "tf",
+    "MobileNetV2": "tf",
+}
+CAFFE_MEAN = np.array([103.939, 116.779, 123.68], dtype="float32")
+
+# One compact record per scored image: its position in the job, the
+# predicted class and the probabilities of every class. Images that could
+# not be read get NO_CLASS and NaN probabilities
+NO_CLASS = -1
+RESULT_DTYPE = np.dtype(
+    [
+        ("index", "int64"),
+        ("class_id", "int8"),
+        ("probabilities", "float32", (len(LABEL_DICT),)),
+    ]
+)
+
+# A layer name that only appears in models built on each backbone
+BACKBONE_LAYERS = {
+    "block1_conv1": "VGG19",
+    "conv1_conv": "ResNet50",
+    "mixed0": "InceptionV3",
+    "expanded_conv_project": "MobileNetV2",
+}
+
+
+def check_backbone(backbone):
+    if backbone not in BACKBONES:
+        raise ValueError(
+            f"Unsupported backbone {backbone!r}. "
+            f"Supported backbones are {', '.join(BACKBONES)}."
+        )
+    return backbone
+
+
+def backbone_module(backbone):
+    check_backbone(backbone)
+    return importlib.import_module(f"keras.applications.{BACKBONES[backbone][0]}")
 
-class VGG19CoffeeClassifier:
-    def __init__(self, pretrained=True, model_path=None):
-        if pretrained:
-            # Load the pre-trained VGG19 model without the top layers
-            self.base_model = VGG19(weights='imagenet', include_top=False)
 
-            # Add new classification layers to the model
-            x = self.base_model.output
-            x = GlobalAveragePooling2D()(x)
-            x = Dense(1024, activation='relu')(x)
-            predictions = Dense(4, activation='softmax')(x)
+def build_pretrained(backbone):
+    # Load the assembled model from the on-disk cache, or build it once and
+    # cache it. Models are only used for inference, so none are compiled
+    from keras.layers import Dense, GlobalAveragePooling2D
+    from keras.models import Model, load_model
 
-            # Define the new model with the added classification layers
-            self.model = Model(inputs=self.base_model.input, outputs=predictions)
+    cache_path = os.path.join(MODEL_CACHE_DIR, f"pretrained_{backbone}.h5")
+    if os.path.exists(cache_path):
+        return load_model(cache_path, compile=False)
 
-            # Freeze the weights of the pre-trained layers
-            for layer in self.base_model.layers:
-                layer.trainable = False
+    # Load the pre-trained backbone without the top layers
+    size = BACKBONES[backbone][1]
+    base_model = getattr(backbone_module(backbone), backbone)(
+        weights="imagenet", include_top=False, input_shape=(size, size, 3)
+    )
 
-            # Compile the model with a SGD optimizer and categorical crossentropy loss
-            self.model.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
+    # Add new classification layers to the model
+    x = base_model.output
+    x = GlobalAveragePooling2D()(x)
+    x = Dense(1024, activation="relu")(x)
+    predictions = Dense(4, activation="softmax")(x)
+
+    # Define the new model with the added classification layers
+    model = Model(inputs=base_model.input, outputs=predictions)
+
+    # Write to a temporary file first so a crash never leaves a torn cache
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path[: -len(".h5")] + f".{os.getpid()}.tmp.h5"
+    model.save(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return model
+
+
+def read_image(source, height, width, out=None):
+    # Load and resize an image from a path or file object, returning its raw
+    # RGB pixels as float32. Same as keras.utils.load_img (nearest resize),
+    # with each step timed. With out, the pixels are written into that
+    # (height, width, 3) array instead of a new one
+    with profiler.stage("read"):
+        if hasattr(source, "read"):
+            data = source.read()
         else:
-            # Load the custom model from the .h5 file
-            self.model = load_model(model_path)
+            with open(source, "rb") as f:
+                data = f.read()
+    with profiler.stage("decode"):
+        try:
+            img = Image.open(io.BytesIO(data))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.load()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # PIL only sees the bytes, so name the file here
+            name = getattr(source, "name", None) or source
+            raise ValueError(f"Could not decode image {name}: {e}") from e
+    with profiler.stage("resize"):
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.NEAREST)
+        if out is None:
+            return np.asarray(img, dtype="float32")
+        out[...] = np.asarray(img)
+        return out
+
+
+def preprocess_in_place(batch, mode):
+    # Same result as the backbone's preprocess_input on raw RGB float32
+    # pixels, but without allocating a copy of the batch
+    if mode == "tf":
+        batch /= 127.5
+        batch -= 1.0
+        return batch
+    # RGB to BGR one image at a time through a single channel-sized plane
+    scratch = np.empty(batch.shape[-3:-1], dtype=batch.dtype)
+    for image in batch.reshape((-1,) + batch.shape[-3:]):
+        np.copyto(scratch, image[..., 0])
+        np.copyto(image[..., 0], image[..., 2])
+        np.copyto(image[..., 2], scratch)
+    batch -= CAFFE_MEAN
+    return batch
+
+
+def make_records(indices, probabilities):
+    # Pack positions and class probabilities into RESULT_DTYPE records
+    probabilities = np.asarray(probabilities, dtype="float32")
+    records = np.empty(len(probabilities), dtype=RESULT_DTYPE)
+    records["index"] = indices
+    if len(records):
+        records["class_id"] = np.where(
+            np.isnan(probabilities).any(axis=1), NO_CLASS, probabilities.argmax(axis=1)
+        )
+    records["probabilities"] = probabilities
+    return records
 
-        # Define the image size for the model input
-        self.img_width, self.img_height = 224, 224
+
+def decode_prediction(preds, label_dict=LABEL_DICT):
+    # Turn a single row of class probabilities into a labelled result
+    if np.isnan(preds).any():
+        return {"accuracy": None, "label": None}
+    pred_index = int(np.argmax(preds))
+    accuracy = preds[pred_index]
+    return {"accuracy": f"{accuracy * 100}%", "label": label_dict[pred_index]}
+
+
+def detect_backbone(model):
+    # Walk the layers, including nested models, looking for a known layer
+    layers = list(model.layers)
+    while layers:
+        layer = layers.pop()
+        if layer.name in BACKBONE_LAYERS:
+            return BACKBONE_LAYERS[layer.name]
+        layers.extend(getattr(layer, "layers", []))
+    return None
+
+
+class VGG19CoffeeClassifier:
+    def __init__(
+        self,
+        pretrained=True,
+        model_path=None,
+        backbone=None,
+        workers=4,
+        prefetch_depth=2,
+    ):
+        if pretrained:
+            # Load the pre-trained backbone (VGG19 by default) with the new
+            # classification layers
+            self.backbone = backbone or "VGG19"
+            self.model = build_pretrained(self.backbone)
+        else:
+            from keras.models import load_model
+
+            # Load the custom model from the .h5 file and work out which
+            # backbone it was trained on
+            self.model = load_model(model_path, compile=False)
+            self.backbone = backbone or detect_backbone(self.model)
+            if self.backbone is None:
+                log.warning("Could not detect the model backbone, assuming VGG19")
+                self.backbone = "VGG19"
+
+        # Apply the preprocessing the backbone was trained with
+        self.preprocess_mode = PREPROCESS_MODES[check_backbone(self.backbone)]
+
+        # Define the image size for the model input, taken from the model
+        default_size = BACKBONES[self.backbone][1]
+        _, height, width, _ = self.model.input_shape
+        self.img_height = height or default_size
+        self.img_width = width or default_size
 
         # Define the label dictionary
-        self.label_dict = {0: "Unripe", 1: "Semi-ripe", 2: "Ripe", 3: "Overripe"}
+        self.label_dict = dict(LABEL_DICT)
+
+        # Number of decode threads and batches to prefetch ahead of the model
+        self.workers = workers
+        self.prefetch_depth = prefetch_depth
+        self._model_id = None
+
+    def warmup(self):
+        # Run a dummy batch through the model so the first real prediction
+        # does not pay for graph tracing and kernel initialisation
+        x = np.zeros((1, self.img_height, self.img_width, 3), dtype="float32")
+        self.predict_batch(x)
+
+    def predict_batch(self, batch):
+        # One forward pass over an already preprocessed batch
+        with profiler.stage("predict", len(batch)):
+            return np.asarray(self.model.predict_on_batch(batch))
+
+    def model_id(self):
+        # Hash of the model weights, used to key cached predictions
+        if self._model_id is None:
+            digest = hashlib.sha1()
+            for weights in self.model.get_weights():
+                digest.update(np.ascontiguousarray(weights).tobytes())
+            self._model_id = digest.hexdigest()
+        return self._model_id
+
+    def memory_bytes(self):
+        # Approximate resident size of the model weights (float32)
+        return self.model.count_params() * 4
+
+    def load_image(self, image_path):
+        # Load and resize the image, returning its raw RGB pixels
+        return read_image(image_path, self.img_height, self.img_width)
+
+    def load_into(self, image_path, out):
+        # Decode the image straight into a slot of a batch buffer
+        read_image(image_path, self.img_height, self.img_width, out=out)
+
+    def preprocess_batch(self, batch):
+        # Preprocess a float32 batch of raw pixels in place
+        with profiler.stage("preprocess", len(batch)):
+            return preprocess_in_place(batch, self.preprocess_mode)
+
+    def decode(self, preds):
+        return decode_prediction(preds, self.label_dict)
+
+    def predict_arrays(self, arrays, batch_size=32):
+        # Run raw RGB pixel arrays of shape (N, height, width, 3) through the
+        # model in fixed-size batches, one forward pass per batch. Every
+        # batch is copied into the same buffer and preprocessed there
+        arrays = np.asarray(arrays)
+        preds = []
+        buffer = np.empty(
+            (min(batch_size, len(arrays)),) + arrays.shape[1:], dtype="float32"
+        )
+        for start in range(0, len(arrays), batch_size):
+            batch = buffer[: len(arrays[start : start + batch_size])]
+            batch[...] = arrays[start : start + batch_size]
+            self.preprocess_batch(batch)
+            preds.append(self.predict_batch(batch))
+        if not preds:
+            return np.zeros((0, len(self.label_dict)), dtype="float32")
+        return np.concatenate(preds)
+
+    def iter_predictions(
+        self, image_paths, batch_size=32, workers=None, depth=None, errors=None
+    ):
+        # Decode the next batches on a thread pool while the current one is
+        # inferred, and yield the start index and class probabilities of
+        # every batch as it is predicted. An unreadable image raises, unless
+        # an errors dict is given: then its probabilities are NaN and its
+        # error is stored there by position
+        prefetcher = ImagePrefetcher(
+            image_paths,
+            self.load_into,
+            (self.img_height, self.img_width, 3),
+            batch_size=batch_size,
+            workers=workers or self.workers,
+            depth=depth or self.prefetch_depth,
+            finish_fn=self.preprocess_batch,
+            skip_errors=errors is not None,
+        )
+        with prefetcher:
+            for start, batch in prefetcher:
+                preds = self.predict_batch(batch)
+                for position in range(start, start + len(preds)):
+                    if position in prefetcher.errors:
+                        preds[position - start] = np.nan
+                        errors[position] = prefetcher.errors.pop(position)
+                yield start, preds
+
+    def iter_records(
+        self, image_paths, batch_size=32, workers=None, depth=None, errors=None
+    ):
+        # Like iter_predictions, but yield a RESULT_DTYPE array per batch
+        for start, preds in self.iter_predictions(
+            image_paths, batch_size, workers, depth, errors
+        ):
+            yield make_records(np.arange(start, start + len(preds)), preds)
+
+    def classify_arrays(self, arrays, batch_size=32):
+        preds = self.predict_arrays(arrays, batch_size=batch_size)
+        return [self.decode(row) for row in preds]
+
+    def classify_batch(self, image_paths, batch_size=32):
+        results = []
+        for _, preds in self.iter_predictions(list(image_paths), batch_size):
+            results.extend(self.decode(row) for row in preds)
+        return results
 
     def classify(self, image_path):
-        # Load the image to classify
-        img = image.load_img(image_path, target_size=(self.img_width, self.img_height))
+        return self.classify_batch([image_path], batch_size=1)[0]
+
+
+def load_interpreter(model_path, num_threads=None):
+    # Prefer the standalone LiteRT runtime, falling back to the interpreter
+    # bundled with TensorFlow
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+
+
+class TFLiteCoffeeClassifier(VGG19CoffeeClassifier):
+    def __init__(
+        self, model_path, backbone=None, num_threads=None, workers=4, prefetch_depth=2
+    ):
+        # The exporter writes the backbone next to the model as JSON
+        metadata = {}
+        if os.path.exists(model_path + ".json"):
+            with open(model_path + ".json") as f:
+                metadata = json.load(f)
+        self.model_path = model_path
+        self.backbone = backbone or metadata.get("backbone") or "VGG19"
+        self.preprocess_mode = PREPROCESS_MODES[check_backbone(self.backbone)]
+
+        self.interpreter = load_interpreter(model_path, num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # The interpreter is not thread safe
+        self._lock = threading.Lock()
+
+        _, self.img_height, self.img_width, _ = self.input["shape"]
+        self.label_dict = dict(LABEL_DICT)
+        self.workers = workers
+        self.prefetch_depth = prefetch_depth
+        self._model_id = None
+
+    def predict_batch(self, batch):
+        with profiler.stage("predict", len(batch)), self._lock:
+            if len(batch) != self._batch_size:
+                self.interpreter.resize_tensor_input(self.input["index"], batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+
+            # Full-int8 models take quantized inputs and return quantized
+            # outputs
+            if self.input["dtype"] == np.int8:
+                scale, zero_point = self.input["quantization"]
+                batch = np.round(batch / scale + zero_point)
+                batch = np.clip(batch, -128, 127).astype(np.int8)
+            self.interpreter.set_tensor(self.input["index"], batch)
+            self.interpreter.invoke()
+            preds = self.interpreter.get_tensor(self.output["index"])
+
+        if self.output["dtype"] == np.int8:
+            scale, zero_point = self.output["quantization"]
+            preds = (preds.astype(np.float32) - zero_point) * scale
+        return preds
+
+    def model_id(self):
+        if self._model_id is None:
+            digest = hashlib.sha1()
+            with open(self.model_path, "rb") as f:
+                digest.update(f.read())
+            self._model_id = digest.hexdigest()
+        return self._model_id
 
-        # Convert the image to an array and preprocess it for input into the model
-        x = image.img_to_array(img)
-        x = np.expand_dims(x, axis=0)
-        x = preprocess_input(x)
+    def memory_bytes(self):
+        return os.path.getsize(self.model_path)
 
-        # Make a prediction with the model
-        preds = self.model.predict(x)
 
-        # Decode the predictions and return the predicted label
-        pred_index = np.argmax(preds)
-        pred_label = self.label_dict[pred_index]
-        accuracy = preds[0][pred_index]
-        return {"accuracy": f"{accuracy * 100}%", "label": pred_label}
+def load_classifier(pretrained=True, model_path=None, backbone=None, **kwargs):
+    # Pick the engine from the model file: .tflite models run on the TFLite
+    # interpreter, everything else through Keras
+    if not pretrained and model_path and model_path.endswith(".tflite"):
+        return TFLiteCoffeeClassifier(model_path, backbone=backbone, **kwargs)
+    return VGG19CoffeeClassifier(
+        pretrained=pretrained, model_path=model_path, backbone=backbone, **kwargs
+    )
 
 
 # Usage
 # vgg_coffee = VGG19CoffeeClassifier(pretrained=True, model_path='my_model.h5')
 # image_path = 'coffee_berry.png'
 # pred_label = vgg_coffee.classify(image_path)
-# print('Predicted:', pred_label)
\ No newline at end of file
+# print('Predicted:', pred_label)
+# pred_labels = vgg_coffee.classify_batch(['berry1.png', 'berry2.png'], batch_size=32)
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from prediction import make_records
+from profiling import profiler
+
+# Default location of the persistent prediction cache
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "abstergo", "predictions.sqlite3"
+)
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    # Hash the image content so renamed or re-added copies still hit the cache
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The connection is shared with worker threads and guarded by a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "image_hash TEXT NOT NULL, "
+                "model_id TEXT NOT NULL, "
+                "probabilities BLOB NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (image_hash, model_id))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_last_used "
+                "ON predictions (last_used)"
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_many(self, image_hashes, model_id):
+        # Return {image_hash: probabilities} for every cached image
+        found = {}
+        image_hashes = list(dict.fromkeys(image_hashes))
+        now = time.time()
+        with self._lock, self._conn:
+            # Stay well below SQLite's limit on bound parameters
+            for start in range(0, len(image_hashes), 500):
+                chunk = image_hashes[start : start + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    "SELECT image_hash, probabilities FROM predictions "
+                    f"WHERE model_id = ? AND image_hash IN ({marks})",
+                    [model_id] + chunk,
+                ).fetchall()
+                for image_hash, blob in rows:
+                    found[image_hash] = np.frombuffer(blob, dtype="float32")
+                self._conn.executemany(
+                    "UPDATE predictions SET last_used = ? "
+                    "WHERE image_hash = ? AND model_id = ?",
+                    [(now, image_hash, model_id) for image_hash, _ in rows],
+                )
+        return found
+
+    def put_many(self, model_id, items):
+        # items is an iterable of (image_hash, probabilities)
+        now = time.time()
+        rows = [
+            (image_hash, model_id, np.asarray(preds, dtype="float32").tobytes(), now)
+            for image_hash, preds in items
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions "
+                "(image_hash, model_id, probabilities, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+
+    def _evict(self):
+        # Drop the least recently used entries once the cache is over size
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM predictions WHERE rowid IN ("
+                "SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        with self._lock:
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM predictions"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def iter_records(
+        self, classifier, image_paths, batch_size=32, workers=4, errors=None
+    ):
+        # Yield RESULT_DTYPE record arrays covering every image, answering
+        # cache hits straight away and sending only the misses through the
+        # model. errors works as in iter_predictions
+        image_paths = list(image_paths)
+        model_id = classifier.model_id()
+
+        def hash_image(position):
+            try:
+                return file_hash(image_paths[position])
+            except OSError as e:
+                if errors is None:
+                    raise
+                errors[position] = str(e)
+                return None
+
+        with profiler.stage("cache", len(image_paths)):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                hashes = list(pool.map(hash_image, range(len(image_paths))))
+            cached = self.get_many([h for h in hashes if h is not None], model_id)
+        failed = [position for position, h in enumerate(hashes) if h is None]
+        if failed:
+            yield make_records(
+                failed, np.full((len(failed), len(classifier.label_dict)), np.nan)
+            )
+        hits = []
+        pending = {}
+        for position, image_hash in enumerate(hashes):
+            if image_hash is None:
+                continue
+            if image_hash in cached:
+                self.hits += 1
+                hits.append(position)
+            else:
+                self.misses += 1
+                # Duplicate images in the same run are only predicted once
+                pending.setdefault(image_hash, []).append(position)
+        for start in range(0, len(hits), batch_size):
+            positions = hits[start : start + batch_size]
+            yield make_records(
+                positions, [cached[hashes[position]] for position in positions]
+            )
+
+        miss_hashes = list(pending)
+        miss_paths = [image_paths[pending[h][0]] for h in miss_hashes]
+        miss_errors = None if errors is None else {}
+        for start, preds in classifier.iter_predictions(
+            miss_paths, batch_size, errors=miss_errors
+        ):
+            batch_hashes = miss_hashes[start : start + len(preds)]
+            # Unreadable images are reported but never cached
+            readable = ~np.isnan(preds).any(axis=1)
+            with profiler.stage("cache", len(preds)):
+                self.put_many(
+                    model_id,
+                    [(h, p) for h, p, ok in zip(batch_hashes, preds, readable) if ok],
+                )
+            if miss_errors:
+                for index, message in miss_errors.items():
+                    for position in pending[miss_hashes[index]]:
+                        errors[position] = message
+                miss_errors.clear()
+            rows = [i for i, h in enumerate(batch_hashes) for _ in pending[h]]
+            positions = [p for h in batch_hashes for p in pending[h]]
+            yield make_records(positions, preds[rows])
+
+    def classify(self, classifier, image_paths, batch_size=32, workers=4):
+        # Yield (position, result) for every image
+        for records in self.iter_records(classifier, image_paths, batch_size, workers):
+            for record in records:
+                yield int(record["index"]), classifier.decode(record["probabilities"])
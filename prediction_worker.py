@@ -0,0 +1,103 @@
+import logging
+import time
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from model_registry import registry
+
+log = logging.getLogger(__name__)
+
+
+class PredictionWorker(QObject):
+    # Emitted with a RESULT_DTYPE array of the records for one batch
+    records = pyqtSignal(object)
+    # Emitted with the number of images done and the total
+    progress = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(
+        self,
+        files,
+        pretrained=True,
+        model_path=None,
+        backbone=None,
+        batch_size=32,
+        cache=None,
+    ):
+        super().__init__()
+        self.files = list(files)
+        self.pretrained = pretrained
+        self.model_path = model_path
+        self.backbone = backbone
+        self.batch_size = batch_size
+        self.cache = cache
+        self._cancelled = False
+
+    def cancel(self):
+        # Checked between batches, so the current batch is allowed to finish
+        self._cancelled = True
+
+    def run(self):
+        try:
+            total = len(self.files)
+            self.progress.emit(0, total)
+            classifier = registry.get(
+                pretrained=self.pretrained,
+                model_path=self.model_path,
+                backbone=self.backbone,
+            )
+            log.info(
+                "Using %s at %dx%d",
+                classifier.backbone,
+                classifier.img_width,
+                classifier.img_height,
+            )
+
+            done = 0
+            errors = {}
+            started = time.perf_counter()
+            for records in self._records(classifier, errors):
+                # Unreadable images come back without a class and are logged
+                for position in list(errors):
+                    log.warning("%s", errors.pop(position))
+                self.records.emit(records)
+                done += len(records)
+                self.progress.emit(done, total)
+                if self._cancelled:
+                    log.info("Prediction cancelled after %d/%d images", done, total)
+                    break
+
+            elapsed = time.perf_counter() - started
+            if done and elapsed > 0:
+                log.info(
+                    "Scored %d images in %.2fs (%.1f images/sec)",
+                    done,
+                    elapsed,
+                    done / elapsed,
+                )
+            if self.cache is not None:
+                stats = self.cache.stats()
+                log.info(
+                    "Prediction cache: %d hits, %d misses, %d entries",
+                    stats["hits"],
+                    stats["misses"],
+                    stats["entries"],
+                )
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            self.finished.emit()
+
+    def _records(self, classifier, errors):
+        # Yield record arrays batch by batch, each image going through the
+        # model at most once and cached images not at all
+        if self.cache is not None:
+            return self.cache.iter_records(
+                classifier,
+                self.files,
+                batch_size=self.batch_size,
+                workers=classifier.workers,
+                errors=errors,
+            )
+        return classifier.iter_records(self.files, self.batch_size, errors=errors)
@@ -0,0 +1,124 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ImagePrefetcher:
+    def __init__(
+        self,
+        image_paths,
+        load_fn,
+        image_shape,
+        batch_size=32,
+        workers=4,
+        depth=2,
+        finish_fn=None,
+        skip_errors=False,
+    ):
+        # load_fn(path, out) decodes an image into out, a float32 view of
+        # image_shape. finish_fn(batch), if given, then transforms the filled
+        # batch in place before it is handed to the consumer. With
+        # skip_errors, an image that fails to load is zeroed and its error
+        # kept in errors by position instead of ending the iteration
+        self.image_paths = list(image_paths)
+        self.load_fn = load_fn
+        self.finish_fn = finish_fn
+        self.skip_errors = skip_errors
+        self.errors = {}
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.depth = max(1, depth)
+
+        # Ring of reusable batch buffers: up to depth batches are decoded
+        # ahead while the consumer holds the one currently being inferred
+        self._buffers = [
+            np.empty((batch_size,) + tuple(image_shape), dtype="float32")
+            for _ in range(self.depth + 1)
+        ]
+        self._free = queue.Queue()
+        for slot in range(len(self._buffers)):
+            self._free.put(slot)
+        self._ready = queue.Queue()
+        self._stop = threading.Event()
+        self._pool = None
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+        slot = None
+        try:
+            while True:
+                # The previous batch has been consumed, hand its buffer back
+                if slot is not None:
+                    self._free.put(slot)
+                    slot = None
+                item = self._ready.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                slot, start, count = item
+                yield start, self._buffers[slot][:count]
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _next_free_slot(self):
+        while not self._stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _load_into(self, buffer, index, image_path, position):
+        try:
+            self.load_fn(image_path, buffer[index])
+        except Exception as e:
+            if not self.skip_errors:
+                raise
+            buffer[index] = 0
+            self.errors[position] = str(e)
+
+    def _fill(self):
+        try:
+            for start in range(0, len(self.image_paths), self.batch_size):
+                slot = self._next_free_slot()
+                if slot is None:
+                    return
+                paths = self.image_paths[start : start + self.batch_size]
+                buffer = self._buffers[slot]
+
+                # Decode the batch in parallel straight into its ring buffer
+                futures = [
+                    self._pool.submit(self._load_into, buffer, i, image_path, start + i)
+                    for i, image_path in enumerate(paths)
+                ]
+                for future in futures:
+                    future.result()
+                if self.finish_fn is not None:
+                    self.finish_fn(buffer[: len(paths)])
+                self._ready.put((slot, start, len(paths)))
+        except BaseException as e:
+            self._ready.put(e)
+        finally:
+            self._ready.put(None)
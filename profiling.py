@@ -0,0 +1,147 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Set ABSTERGO_PROFILE=1 to profile from startup; the GUI, score.py and
+# server.py can also switch it on at runtime
+PROFILE_ENV = "ABSTERGO_PROFILE"
+
+# Histogram bucket upper bounds in seconds: 10us to ~100s, 4 per decade
+BUCKETS = [10 ** (exponent / 4) for exponent in range(-20, 9)]
+
+# The order stages are reported in; unknown stages are appended after these
+STAGES = ["read", "decode", "resize", "preprocess", "cache", "predict", "table"]
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        # One counter per bucket plus an overflow bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, items):
+        self.calls += 1
+        self.items += items
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th percentile call
+        target = q / 100 * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "total_sec": round(self.total, 6),
+            "mean_ms": round(self.total / self.calls * 1000, 3),
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p90_ms": round(self.percentile(90) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "histogram": {
+                f"<={bound * 1000:.3g}ms": count
+                for bound, count in zip(BUCKETS, self.counts)
+                if count
+            },
+        }
+
+
+class Profiler:
+    def __init__(self, enabled=False):
+        # Read without the lock on every stage, so switching profiling off
+        # costs one attribute check per call
+        self.enabled = enabled
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, items=1):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = StageStats()
+            stats.add(seconds, items)
+
+    @contextlib.contextmanager
+    def _timed(self, name, items):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, items)
+
+    def stage(self, name, items=1):
+        # Time a block of code under a stage name; items is the number of
+        # images it handled, for per-image rates
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name, items)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self._stats)
+        order = STAGES + sorted(name for name in stats if name not in STAGES)
+        return {name: stats[name].summary() for name in order if name in stats}
+
+    def report(self):
+        # A fixed-width table of the stages, slowest total first
+        summary = self.summary()
+        if not summary:
+            return "No profile data recorded"
+        overall = sum(stats["total_sec"] for stats in summary.values()) or 1
+        lines = [
+            f"{'stage':<12}{'calls':>8}{'items':>8}{'total s':>10}{'share':>8}"
+            f"{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}"
+        ]
+        for name, stats in sorted(
+            summary.items(), key=lambda item: -item[1]["total_sec"]
+        ):
+            lines.append(
+                f"{name:<12}{stats['calls']:>8}{stats['items']:>8}"
+                f"{stats['total_sec']:>10.3f}"
+                f"{stats['total_sec'] / overall:>8.0%}"
+                f"{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+                f"{stats['p99_ms']:>10.2f}"
+            )
+        return "\n".join(lines)
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump({"stages": self.summary()}, f, indent=2)
+
+
+@contextlib.contextmanager
+def trace(logdir):
+    # Capture a TensorFlow profiler trace of the block, viewable in
+    # TensorBoard's Profile tab. Does nothing without a log directory
+    if not logdir:
+        yield
+        return
+    import tensorflow as tf
+
+    tf.profiler.experimental.start(logdir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+
+
+# Shared by every classifier in the process
+profiler = Profiler(enabled=os.environ.get(PROFILE_ENV, "") not in ("", "0"))
@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+import numpy as np
+
+from prediction import RESULT_DTYPE
+
+# Records kept in memory before they are appended to the spill file
+DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+
+
+class ResultStore:
+    def __init__(
+        self, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None, dtype=RESULT_DTYPE
+    ):
+        # Append-only store of prediction records. Records collect in one
+        # preallocated chunk sized from the memory budget; a full chunk is
+        # written to a temporary file and reused, so memory stays bounded
+        # however many images are scored
+        self.dtype = np.dtype(dtype)
+        self.capacity = max(1, memory_budget // self.dtype.itemsize)
+        self.spill_dir = spill_dir
+        self._chunk = np.empty(self.capacity, dtype=self.dtype)
+        self._count = 0
+        self._spilled = 0
+        self._path = None
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._spilled + self._count
+
+    def append(self, records):
+        records = np.asarray(records, dtype=self.dtype)
+        while len(records):
+            count = min(len(records), self.capacity - self._count)
+            self._chunk[self._count : self._count + count] = records[:count]
+            self._count += count
+            records = records[count:]
+            if self._count == self.capacity:
+                self._spill()
+
+    def _spill(self):
+        if self._file is None:
+            fd, self._path = tempfile.mkstemp(
+                suffix=".records", prefix="abstergo-", dir=self.spill_dir
+            )
+            self._file = os.fdopen(fd, "wb")
+        self._chunk[: self._count].tofile(self._file)
+        self._file.flush()
+        self._spilled += self._count
+        self._count = 0
+
+    def iter_chunks(self):
+        # Yield the records in order, at most one chunk at a time. Spilled
+        # records are memory-mapped rather than read back in
+        if self._spilled:
+            spilled = np.memmap(
+                self._path, dtype=self.dtype, mode="r", shape=(self._spilled,)
+            )
+            for start in range(0, self._spilled, self.capacity):
+                yield spilled[start : start + self.capacity]
+            del spilled
+        if self._count:
+            yield self._chunk[: self._count]
+
+    def class_counts(self, num_classes):
+        # Number of records predicted as each class; unreadable images
+        # (class_id NO_CLASS) are not counted
+        counts = np.zeros(num_classes, dtype="int64")
+        for chunk in self.iter_chunks():
+            class_ids = chunk["class_id"]
+            counts += np.bincount(class_ids[class_ids >= 0], minlength=num_classes)
+        return counts
+
+    def close(self):
+        # Drop every record and delete the spill file
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path is not None:
+            os.remove(self._path)
+            self._path = None
+        self._count = self._spilled = 0
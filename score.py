@@ -0,0 +1,266 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from parallel_scoring import parallel_predictions
+from prediction import BACKBONES, decode_prediction, load_classifier
+from prediction_cache import PredictionCache
+from profiling import profiler, trace
+
+# Same image types the GUI file dialog accepts
+IMAGE_EXTENSIONS = (".png", ".xpm", ".jpg", ".jpeg", ".bmp", ".gif")
+FIELDS = ["path", "label", "accuracy", "error"]
+
+
+def find_images(inputs, file_list=None):
+    # Expand directories recursively and keep plain files as they are
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(os.path.join(root, name))
+        else:
+            paths.append(item)
+    if file_list:
+        with open(file_list) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    return list(dict.fromkeys(paths))
+
+
+def truncate_partial_line(output):
+    # Drop a half-written last record left behind by an interrupted run
+    with open(output, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+
+
+def load_checkpoint(output, output_format):
+    # The output file doubles as the checkpoint: every path already written
+    # to it has been scored and is skipped when resuming
+    if not os.path.exists(output):
+        return set()
+    truncate_partial_line(output)
+    with open(output, newline="") as f:
+        if output_format == "jsonl":
+            return {json.loads(line)["path"] for line in f if line.strip()}
+        return {row["path"] for row in csv.DictReader(f)}
+
+
+class ResultWriter:
+    def __init__(self, output, output_format, append):
+        self.output_format = output_format
+        fields = FIELDS
+        if output_format == "csv" and append and os.path.exists(output):
+            # Keep the columns of a file written by an older version
+            with open(output, newline="") as f:
+                fields = next(csv.reader(f), FIELDS)
+        self.file = open(output, "a" if append else "w", newline="")
+        if output_format == "csv":
+            self.writer = csv.DictWriter(
+                self.file, fieldnames=fields, extrasaction="ignore"
+            )
+            if self.file.tell() == 0:
+                self.writer.writeheader()
+
+    def write(self, path, data):
+        row = {
+            "path": path,
+            "label": data["label"],
+            "accuracy": data["accuracy"],
+            "error": data.get("error"),
+        }
+        if self.output_format == "jsonl":
+            self.file.write(json.dumps(row) + "\n")
+        else:
+            self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def iter_predictions(classifier, paths, args, cache, errors):
+    # Yield (positions, probabilities) one batch at a time
+    if args.processes > 1:
+        for start, preds in parallel_predictions(
+            paths,
+            pretrained=args.model is None,
+            model_path=args.model,
+            backbone=args.backbone,
+            processes=args.processes,
+            threads=args.threads,
+            decoders=args.workers,
+            batch_size=args.batch_size,
+            pin=args.pin,
+            errors=errors,
+        ):
+            yield range(start, start + len(preds)), preds
+        return
+    if cache is not None:
+        # One pass over every path, so hashing and decoding overlap inference
+        # as without the cache. Hits come first, so batches are not in input
+        # order
+        for records in cache.iter_records(
+            classifier,
+            paths,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            errors=errors,
+        ):
+            yield records["index"], records["probabilities"]
+        return
+    for start, preds in classifier.iter_predictions(
+        paths, batch_size=args.batch_size, workers=args.workers, errors=errors
+    ):
+        yield range(start, start + len(preds)), preds
+
+
+def iter_results(classifier, paths, args, cache=None):
+    # Yield (paths, results) one batch at a time. An unreadable image gets a
+    # result carrying its error instead of ending the run, so a resumed run
+    # skips it
+    errors = {}
+    for positions, preds in iter_predictions(classifier, paths, args, cache, errors):
+        results = []
+        for position, row in zip(positions, preds):
+            data = decode_prediction(row)
+            data["error"] = errors.pop(position, None)
+            results.append(data)
+        yield [paths[i] for i in positions], results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Score coffee cherry images without the GUI."
+    )
+    parser.add_argument("inputs", nargs="*", help="image files or directories")
+    parser.add_argument("--file-list", help="text file with one image path per line")
+    parser.add_argument("-o", "--output", required=True, help="CSV or JSONL file")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None)
+    parser.add_argument(
+        "--model", help="custom .h5 or .tflite model (default: pretrained)"
+    )
+    parser.add_argument(
+        "--backbone",
+        choices=list(BACKBONES),
+        help="backbone of the pretrained model (custom models are detected)",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="decode threads (decode processes with --processes)",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=1, help="model processes to score with"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="TensorFlow threads per model process (default: cores split evenly)",
+    )
+    parser.add_argument(
+        "--pin", action="store_true", help="pin each model process to its own cores"
+    )
+    parser.add_argument(
+        "--no-resume", action="store_true", help="rescore everything from scratch"
+    )
+    parser.add_argument(
+        "--cache", nargs="?", const="", default=None, help="use the prediction cache"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="print per-stage timings at the end"
+    )
+    parser.add_argument("--profile-output", help="write per-stage timings as JSON")
+    parser.add_argument(
+        "--trace-dir", help="capture a TensorFlow profiler trace into this directory"
+    )
+    args = parser.parse_args(argv)
+    if args.processes > 1 and args.cache is not None:
+        parser.error("--cache cannot be combined with --processes")
+    if args.processes > 1 and (args.profile or args.profile_output):
+        # Stages are timed in the model and decode processes, whose timings
+        # never reach this one
+        parser.error("--profile cannot be combined with --processes")
+    if args.profile or args.profile_output:
+        profiler.enabled = True
+
+    output_format = args.format or (
+        "jsonl" if args.output.endswith((".jsonl", ".json")) else "csv"
+    )
+    paths = find_images(args.inputs, args.file_list)
+    if not paths:
+        parser.error("no images found")
+
+    done = set() if args.no_resume else load_checkpoint(args.output, output_format)
+    todo = [path for path in paths if path not in done]
+    print(
+        f"{len(paths)} images found, {len(paths) - len(todo)} already scored",
+        file=sys.stderr,
+    )
+    if not todo:
+        return 0
+
+    # With several processes every one loads its own model
+    classifier = None
+    if args.processes == 1:
+        classifier = load_classifier(
+            pretrained=args.model is None,
+            model_path=args.model,
+            backbone=args.backbone,
+            workers=args.workers,
+        )
+    cache = None
+    if args.cache is not None:
+        cache = PredictionCache(args.cache) if args.cache else PredictionCache()
+
+    writer = ResultWriter(args.output, output_format, append=not args.no_resume)
+    scored = failed = 0
+    started = time.perf_counter()
+    try:
+        with trace(args.trace_dir):
+            for batch_paths, results in iter_results(classifier, todo, args, cache):
+                for path, data in zip(batch_paths, results):
+                    writer.write(path, data)
+                    if data["error"]:
+                        failed += 1
+                        print(data["error"], file=sys.stderr)
+                # Flush every batch so an interrupted run can resume from here
+                writer.flush()
+                scored += len(batch_paths)
+                rate = scored / (time.perf_counter() - started)
+                print(
+                    f"{scored}/{len(todo)} images ({rate:.1f} images/sec)",
+                    file=sys.stderr,
+                )
+    except KeyboardInterrupt:
+        print("Interrupted, rerun the same command to resume", file=sys.stderr)
+        return 130
+    finally:
+        writer.close()
+        if profiler.enabled:
+            print(profiler.report(), file=sys.stderr)
+        if args.profile_output:
+            profiler.export(args.profile_output)
+
+    if failed:
+        print(f"{failed} images could not be read", file=sys.stderr)
+    if cache is not None:
+        print(f"Prediction cache: {cache.stats()}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from prediction import BACKBONES, load_classifier
+from profiling import profiler
+
+# Refuse request bodies larger than this
+MAX_BODY_BYTES = 32 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.started = time.time()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        # Latencies of the most recent requests, in seconds
+        self.latencies = deque(maxlen=window)
+
+    def snapshot(self):
+        uptime = time.time() - self.started
+        snapshot = {
+            "uptime_sec": round(uptime, 3),
+            "requests": self.requests,
+            "images": self.images,
+            "batches": self.batches,
+            "errors": self.errors,
+            "mean_batch_size": (
+                round(self.images / self.batches, 2) if self.batches else 0
+            ),
+            "images_per_sec": round(self.images / uptime, 2) if uptime else 0,
+        }
+        if self.latencies:
+            p50, p95, p99 = np.percentile(list(self.latencies), [50, 95, 99])
+            snapshot["latency_ms"] = {
+                "p50": round(p50 * 1000, 2),
+                "p95": round(p95 * 1000, 2),
+                "p99": round(p99 * 1000, 2),
+            }
+        if profiler.enabled:
+            snapshot["stages"] = profiler.summary()
+        return snapshot
+
+
+class MicroBatcher:
+    def __init__(self, classifier, metrics, max_batch_size=32, max_wait_ms=10):
+        self.classifier = classifier
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # A single model thread keeps forward passes from overlapping
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, pixels):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((pixels, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a request, then gather more until the batch is full
+            # or the oldest request has waited max_wait
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            arrays = np.stack([pixels for pixels, _ in batch])
+            try:
+                preds = await loop.run_in_executor(
+                    self.model_executor,
+                    self.classifier.predict_arrays,
+                    arrays,
+                    len(batch),
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.metrics.batches += 1
+            self.metrics.images += len(batch)
+            for (_, future), row in zip(batch, preds):
+                if not future.done():
+                    future.set_result(self.classifier.decode(row))
+
+
+class InferenceServer:
+    def __init__(self, classifier, max_batch_size=32, max_wait_ms=10, workers=4):
+        self.classifier = classifier
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(
+            classifier, self.metrics, max_batch_size, max_wait_ms
+        )
+        self.decode_executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                started = time.perf_counter()
+                try:
+                    status, payload = 200, await self.route(method, path, headers, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 400, {"error": str(e)}
+                if status != 200:
+                    self.metrics.errors += 1
+                if path.startswith("/predict"):
+                    self.metrics.requests += 1
+                    self.metrics.latencies.append(time.perf_counter() - started)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            await self.write_response(writer, e.status, {"error": str(e)}, False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        parts = request_line.decode("latin-1").split(" ", 2)
+        if len(parts) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, path, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), path, headers, body
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def route(self, method, path, headers, body):
+        path = path.split("?", 1)[0]
+        if method == "GET" and path == "/health":
+            return {
+                "status": "ok",
+                "backbone": self.classifier.backbone,
+                "queued": self.batcher.queue.qsize(),
+            }
+        if method == "GET" and path == "/metrics":
+            return self.metrics.snapshot()
+        if method == "POST" and path == "/predict":
+            return await self.predict(headers, body)
+        raise HTTPError(404, f"no route for {method} {path}")
+
+    async def predict(self, headers, body):
+        # JSON bodies name local image paths, anything else is an upload
+        single = True
+        if headers.get("content-type", "").startswith("application/json"):
+            request = json.loads(body or b"{}")
+            if "paths" in request:
+                sources = list(request["paths"])
+                single = False
+            elif "path" in request:
+                sources = [request["path"]]
+            else:
+                raise HTTPError(400, "expected 'path' or 'paths'")
+        elif body:
+            sources = [io.BytesIO(body)]
+        else:
+            raise HTTPError(400, "empty request body")
+
+        loop = asyncio.get_running_loop()
+        pixels = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.decode_executor, self.classifier.load_image, source
+                )
+                for source in sources
+            ]
+        )
+        results = await asyncio.gather(*[self.batcher.submit(p) for p in pixels])
+        return results[0] if single else results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve coffee ripeness predictions over HTTP."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--model", help="custom .h5 or .tflite model (default: pretrained)"
+    )
+    parser.add_argument(
+        "--backbone",
+        choices=list(BACKBONES),
+        help="backbone of the pretrained model (custom models are detected)",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="decode threads")
+    parser.add_argument(
+        "--profile", action="store_true", help="add per-stage timings to /metrics"
+    )
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiler.enabled = True
+
+    classifier = load_classifier(
+        pretrained=args.model is None, model_path=args.model, backbone=args.backbone
+    )
+    classifier.warmup()
+    # Leave the warmup pass out of the stage timings
+    profiler.reset()
+    server = InferenceServer(
+        classifier, args.max_batch_size, args.max_wait_ms, args.workers
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
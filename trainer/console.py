@@ -1,19 +1,96 @@
+import logging
+import re
 import sys
-from PyQt5 import QtWidgets
+import threading
+
+from PyQt5 import QtCore, QtWidgets
+
+# Control and non-ASCII characters (progress bar glyphs, backspaces, escape
+# codes) that the plain text log cannot show
+UNPRINTABLE = re.compile(r"[^\x20-\x7E\t]+")
+
+
+class ConsoleHandler(logging.Handler):
+    # Sends log records to a Console; safe to use from any thread
+    def __init__(self, console):
+        super().__init__()
+        self.console = console
+
+    def emit(self, record):
+        try:
+            self.console.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
 
 
 class Console(QtWidgets.QPlainTextEdit):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, max_lines=5000, interval_ms=100):
         super().__init__(parent)
         self.setReadOnly(True)
+        # Oldest lines are dropped once the log holds max_lines
+        self.setMaximumBlockCount(max_lines)
+
+        # Writes only append to a buffer under a lock, from any thread; the
+        # GUI thread moves complete lines into the widget on a timer
+        self._lock = threading.Lock()
+        self._pending = []
+        self._partial = ""
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._drain)
+        self._timer.start(interval_ms)
+
+        # Route print() output and log records into the console
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         sys.stdout = self
         sys.stderr = self
+        self.handler = ConsoleHandler(self)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(logging.INFO)
 
     def write(self, text):
-        self.insertPlainText(text)
+        with self._lock:
+            self._pending.append(text)
+        return len(text)
+
+    def flush(self):
+        # Pending text is shown on the next timer tick
+        pass
+
+    def isatty(self):
+        # Keeps Keras from redrawing progress bars on every step
+        return False
+
+    def _drain(self):
+        with self._lock:
+            if not self._pending:
+                return
+            text = self._partial + "".join(self._pending)
+            self._pending = []
+
+        # Hold back an unfinished last line until its newline arrives
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        if not lines:
+            return
+
+        # A carriage return redraws the line, so only its last state is kept
+        lines = [
+            UNPRINTABLE.sub("", line.rstrip("\r").rsplit("\r", 1)[-1]) for line in lines
+        ]
+        # Drop lines that would scroll straight out of the bounded history
+        lines = lines[-self.maximumBlockCount() :]
+
+        # One insert per tick, keeping the view pinned to the bottom only if
+        # the user has not scrolled up
+        scrollbar = self.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        self.appendPlainText("\n".join(lines))
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
     def toggle_console(self):
         # Toggle the visibility of the console widget
-        self.console.setVisible(not self.console.isVisible())
+        self.setVisible(not self.isVisible())
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+
+from feature_cache import file_hash
+
+# ioctl request for a copy-on-write clone on Linux (btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def reflink(source, target):
+    import fcntl
+
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+def link_or_copy(source, target):
+    # Prefer a hardlink, then a reflink, and only copy the bytes as a last
+    # resort (e.g. across filesystems)
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    try:
+        reflink(source, target)
+        return
+    except (OSError, ImportError):
+        pass
+    shutil.copy2(source, target)
+
+
+class DatasetStore:
+    def __init__(self, root="../dataset", labels=(), validation_fraction=0.2):
+        self.root = root
+        self.validation_fraction = validation_fraction
+        self.manifest_path = os.path.join(root, "manifest.json")
+
+        # images: hash -> {label, split, source, path}
+        # sources: source path -> {mtime, size, hash}, to avoid rehashing
+        self.images = {}
+        self.sources = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.images = manifest["images"]
+            self.sources = manifest["sources"]
+
+        # Every label needs a folder in both splits so class indices match
+        for split in ("train", "validation"):
+            for label in labels:
+                os.makedirs(os.path.join(root, split, label), exist_ok=True)
+
+    def split_for(self, image_hash):
+        # Deterministic split from the content hash: the same image always
+        # lands in the same split, however often it is ingested
+        bucket = int(image_hash[:8], 16) % 1000
+        return "validation" if bucket < self.validation_fraction * 1000 else "train"
+
+    def source_hash(self, source):
+        stat = os.stat(source)
+        known = self.sources.get(source)
+        if known and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+            return known["hash"]
+        image_hash = file_hash(source)
+        self.sources[source] = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "hash": image_hash,
+        }
+        return image_hash
+
+    def ingest(self, items):
+        # items is an iterable of (source path, label). Only new or relabeled
+        # images touch the filesystem; returns counts of what changed
+        counts = {"added": 0, "relabeled": 0, "unchanged": 0}
+        for source, label in items:
+            source = os.path.abspath(source)
+            image_hash = self.source_hash(source)
+            split = self.split_for(image_hash)
+            extension = os.path.splitext(source)[1].lower()
+            path = os.path.join(split, label, image_hash + extension)
+            target = os.path.join(self.root, path)
+
+            entry = self.images.get(image_hash)
+            if entry is not None and entry["path"] == path and os.path.exists(target):
+                counts["unchanged"] += 1
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            old_target = entry and os.path.join(self.root, entry["path"])
+            if old_target and os.path.exists(old_target):
+                # Relabeled: move the existing file instead of linking again
+                os.replace(old_target, target)
+                counts["relabeled"] += 1
+            else:
+                link_or_copy(source, target)
+                counts["added"] += 1
+            self.images[image_hash] = {
+                "label": label,
+                "split": split,
+                "source": source,
+                "path": path,
+            }
+
+        self.save()
+        return counts
+
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"images": self.images, "sources": self.sources}, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
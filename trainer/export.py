@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications import (
+    inception_v3,
+    mobilenet_v2,
+    resnet50,
+    vgg19,
+)
+
+from pipeline import DirectoryDataset, image_batches
+
+# The TFLite engine and backbone detection are shared with the application
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from prediction import TFLiteCoffeeClassifier, detect_backbone
+
+PREPROCESSORS = {
+    "VGG19": vgg19.preprocess_input,
+    "ResNet50": resnet50.preprocess_input,
+    "InceptionV3": inception_v3.preprocess_input,
+    "MobileNetV2": mobilenet_v2.preprocess_input,
+}
+
+
+def representative_dataset(calibration_dir, img_size, preprocess, samples=100, seed=0):
+    # A random sample of training images, one per call, for int8 calibration
+    data = DirectoryDataset(calibration_dir, img_size, seed=seed)
+    rng = np.random.default_rng(seed)
+    paths = rng.permutation(data.filepaths)[:samples]
+
+    def generator():
+        for batch in image_batches(paths, img_size, 1, preprocess):
+            yield [batch]
+
+    return generator
+
+
+def export_tflite(
+    model,
+    output_prefix,
+    backbone,
+    calibration_dir="../dataset/train",
+    samples=100,
+):
+    # Write dynamic-range and full-int8 quantized models next to a metadata
+    # file naming the backbone, so the classifier can preprocess inputs
+    img_size = model.input_shape[1]
+    exported = {}
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    exported["dynamic"] = converter.convert()
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(
+        calibration_dir, img_size, PREPROCESSORS[backbone], samples
+    )
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    exported["int8"] = converter.convert()
+
+    paths = {}
+    for quantization, content in exported.items():
+        path = f"{output_prefix}.{quantization}.tflite"
+        with open(path, "wb") as f:
+            f.write(content)
+        with open(path + ".json", "w") as f:
+            json.dump(
+                {
+                    "backbone": backbone,
+                    "input_size": img_size,
+                    "quantization": quantization,
+                },
+                f,
+            )
+        paths[quantization] = path
+        print(f"Wrote {path} ({len(content) / 1e6:.1f} MB)")
+    return paths
+
+
+def export_onnx(model, output_path):
+    # Optional: needs the tf2onnx package
+    try:
+        import tf2onnx
+    except ImportError:
+        raise ImportError("ONNX export requires tf2onnx: pip install tf2onnx")
+    spec = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, output_path=output_path)
+    print(f"Wrote {output_path}")
+    return output_path
+
+
+def measure_latency(predict, x, runs=50):
+    # p50 and p95 latency of predict(x) in seconds, after one warm-up call
+    predict(x)
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        predict(x)
+        latencies.append(time.perf_counter() - started)
+    return np.percentile(latencies, [50, 95])
+
+
+def evaluate(predict, data, preprocess, batch_size=32, latency_runs=50):
+    # Validation accuracy plus single-image latency percentiles
+    correct = 0
+    batches = image_batches(data.filepaths, data.img_size, batch_size, preprocess)
+    for start, x in zip(range(0, data.samples, batch_size), batches):
+        preds = np.asarray(predict(x.numpy()))
+        correct += int(
+            np.sum(np.argmax(preds, axis=1) == data.classes[start : start + len(x)])
+        )
+
+    single = next(iter(image_batches(data.filepaths[:1], data.img_size, 1, preprocess)))
+    p50, p95 = measure_latency(predict, single.numpy(), latency_runs)
+    return {
+        "accuracy": correct / max(data.samples, 1),
+        "latency_p50_ms": round(p50 * 1000, 3),
+        "latency_p95_ms": round(p95 * 1000, 3),
+    }
+
+
+def compare(model_path, exported, backbone, validation_dir="../dataset/validation"):
+    # Accuracy-vs-latency report of the float model against each export
+    model = tf.keras.models.load_model(model_path, compile=False)
+    data = DirectoryDataset(validation_dir, model.input_shape[1])
+    preprocess = PREPROCESSORS[backbone]
+
+    report = {}
+    float_result = evaluate(model.predict_on_batch, data, preprocess)
+    float_result["size_mb"] = round(os.path.getsize(model_path) / 1e6, 2)
+    report["float"] = float_result
+    for quantization, path in exported.items():
+        # Served exactly as the application serves it, int8 quantization
+        # included
+        classifier = TFLiteCoffeeClassifier(path, backbone=backbone)
+        result = evaluate(classifier.predict_batch, data, preprocess)
+        result["size_mb"] = round(os.path.getsize(path) / 1e6, 2)
+        report[quantization] = result
+
+    print(f"{'model':<10}{'accuracy':>10}{'p50 ms':>10}{'p95 ms':>10}{'size MB':>10}")
+    for name, result in report.items():
+        print(
+            f"{name:<10}{result['accuracy']:>10.4f}{result['latency_p50_ms']:>10.2f}"
+            f"{result['latency_p95_ms']:>10.2f}{result['size_mb']:>10.2f}"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a trained model to quantized TFLite for CPU serving."
+    )
+    parser.add_argument("model", nargs="?", default="model.h5")
+    parser.add_argument(
+        "--backbone",
+        choices=list(PREPROCESSORS),
+        help="backbone the model was trained on (default: detected from the model)",
+    )
+    parser.add_argument("--calibration-dir", default="../dataset/train")
+    parser.add_argument("--validation-dir", default="../dataset/validation")
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--onnx", action="store_true", help="also export ONNX")
+    parser.add_argument("--report", help="write the comparison report as JSON")
+    args = parser.parse_args()
+
+    prefix = os.path.splitext(args.model)[0]
+    keras_model = tf.keras.models.load_model(args.model, compile=False)
+    args.backbone = args.backbone or detect_backbone(keras_model)
+    if args.backbone is None:
+        parser.error("could not detect the model backbone, pass --backbone")
+    exported = export_tflite(
+        keras_model, prefix, args.backbone, args.calibration_dir, args.samples
+    )
+    if args.onnx:
+        export_onnx(keras_model, prefix + ".onnx")
+
+    report = compare(args.model, exported, args.backbone, args.validation_dir)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
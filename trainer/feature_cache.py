@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    def __init__(
+        self, cache_dir, backbone_name, feature_shape, signature="", dtype="float16"
+    ):
+        # One store per backbone (and input size), rows keyed by file hash.
+        # signature names the preprocessing the features were computed with
+        self.dir = os.path.join(cache_dir, backbone_name)
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.features_path = os.path.join(self.dir, "features.npy")
+        self.feature_shape = tuple(feature_shape)
+        self.signature = signature
+        self.dtype = np.dtype(dtype)
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.rows = {}
+        self.features = None
+        if os.path.exists(self.index_path) and os.path.exists(self.features_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            # A store built for a different feature shape or preprocessing
+            # is discarded
+            if (
+                tuple(index["feature_shape"]) == self.feature_shape
+                and index.get("signature", "") == self.signature
+            ):
+                self.rows = index["rows"]
+                self.features = np.load(self.features_path, mmap_mode="r+")
+        if self.features is None:
+            self._allocate(1024)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, image_hash):
+        return image_hash in self.rows
+
+    def get(self, image_hashes):
+        # Gather the cached features of the given images into memory
+        rows = np.array([self.rows[h] for h in image_hashes], dtype="int64")
+        return np.asarray(self.features[rows])
+
+    def add(self, image_hashes, features):
+        needed = len(self.rows) + len(image_hashes)
+        if needed > len(self.features):
+            self._allocate(max(needed, 2 * len(self.features)))
+        for image_hash, feature in zip(image_hashes, features):
+            row = self.rows.setdefault(image_hash, len(self.rows))
+            self.features[row] = feature
+
+    def flush(self):
+        self.features.flush()
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "feature_shape": list(self.feature_shape),
+                    "signature": self.signature,
+                    "rows": self.rows,
+                },
+                f,
+            )
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _allocate(self, capacity):
+        # Grow the memory-mapped store, keeping the rows already written
+        tmp_path = self.features_path + ".tmp"
+        features = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=self.dtype,
+            shape=(capacity,) + self.feature_shape,
+        )
+        if self.features is not None:
+            features[: len(self.rows)] = self.features[: len(self.rows)]
+            del self.features
+        features.flush()
+        os.replace(tmp_path, self.features_path)
+        self.features = features
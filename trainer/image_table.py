@@ -0,0 +1,316 @@
+import bisect
+import hashlib
+import os
+import threading
+from array import array
+from collections import OrderedDict, deque
+
+from PyQt5.QtCore import (
+    QAbstractTableModel,
+    QModelIndex,
+    QObject,
+    QSize,
+    Qt,
+    pyqtSignal,
+)
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+from PyQt5.QtWidgets import (
+    QAbstractItemView,
+    QComboBox,
+    QHeaderView,
+    QStyledItemDelegate,
+)
+
+# Thumbnails are also kept on disk so reopening a folder is instant
+THUMBNAIL_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "abstergo", "thumbnails"
+)
+THUMBNAIL_SIZE = 48
+NO_LABEL = -1
+
+
+def load_scaled(path, height):
+    # Decode straight to the target size instead of loading the full image
+    # and scaling it; JPEGs are downscaled while decoding
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and size.height() > height:
+        reader.setScaledSize(
+            QSize(max(1, size.width() * height // size.height()), height)
+        )
+    return reader.read()
+
+
+class ThumbnailCache(QObject):
+    # Emitted from a loader thread when a thumbnail becomes available
+    ready = pyqtSignal(str)
+
+    def __init__(
+        self,
+        size=THUMBNAIL_SIZE,
+        max_items=1024,
+        cache_dir=THUMBNAIL_CACHE_DIR,
+        workers=2,
+        max_pending=256,
+        parent=None,
+    ):
+        super().__init__(parent)
+        self.size = size
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_pending = max_pending
+        self._images = OrderedDict()
+        self._pending = set()
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._workers = [
+            threading.Thread(target=self._load_loop, daemon=True)
+            for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def get(self, path):
+        # Return the thumbnail if it is cached, otherwise queue it and
+        # return None; ready is emitted once it has loaded
+        with self._lock:
+            image = self._images.get(path)
+            if image is not None:
+                self._images.move_to_end(path)
+                return image
+            if path not in self._pending:
+                self._pending.add(path)
+                self._queue.append(path)
+                # Rows scrolled past long ago are dropped; they are asked
+                # for again if they come back into view
+                while len(self._queue) > self.max_pending:
+                    self._pending.discard(self._queue.popleft())
+                self._wakeup.notify()
+        return None
+
+    def _load_loop(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._wakeup.wait()
+                # Newest first, so the rows on screen load before old ones
+                path = self._queue.pop()
+            image = self._load(path)
+            with self._lock:
+                self._pending.discard(path)
+                self._images[path] = image
+                self._images.move_to_end(path)
+                while len(self._images) > self.max_items:
+                    self._images.popitem(last=False)
+            self.ready.emit(path)
+
+    def _disk_path(self, path):
+        # Keyed by path, modification time and size so edited files are
+        # regenerated
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{self.size}"
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png"
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def _load(self, path):
+        disk_path = self._disk_path(path)
+        if disk_path and os.path.exists(disk_path):
+            image = QImage(disk_path)
+            if not image.isNull():
+                return image
+        image = load_scaled(path, self.size)
+        if disk_path and not image.isNull():
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            # Write to a temporary file first so readers never see a torn file
+            tmp_path = f"{disk_path}.{threading.get_ident()}.tmp.png"
+            if image.save(tmp_path, "PNG"):
+                os.replace(tmp_path, disk_path)
+        return image
+
+
+class ImageTableModel(QAbstractTableModel):
+    # Columns: file name, label and, if there are three headers, score
+    PATH, LABEL, SCORE = range(3)
+
+    def __init__(
+        self,
+        labels,
+        headers,
+        editable=False,
+        default_label=NO_LABEL,
+        thumbnails=None,
+        parent=None,
+    ):
+        super().__init__(parent)
+        self.labels = list(labels)
+        self.headers = list(headers)
+        self.editable = editable
+        self.default_label = default_label
+        self.thumbnails = thumbnails
+        if thumbnails is not None:
+            thumbnails.ready.connect(self._thumbnail_ready)
+
+        # One entry per row: a path string, a label index, a score and an id
+        # that stays with the row when rows above it are removed. Views only
+        # ask for the rows on screen, so this scales to 100k rows
+        self.paths = []
+        self.label_ids = array("b")
+        self.scores = array("f")
+        self.ids = array("q")
+        self._next_id = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if self.editable and index.column() == self.LABEL:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        if column == self.PATH:
+            if role in (Qt.DisplayRole, Qt.ToolTipRole):
+                return self.paths[row]
+            if role == Qt.DecorationRole and self.thumbnails is not None:
+                return self.thumbnails.get(self.paths[row])
+        elif column == self.LABEL and role in (Qt.DisplayRole, Qt.EditRole):
+            label_id = self.label_ids[row]
+            return self.labels[label_id] if label_id != NO_LABEL else None
+        elif column == self.SCORE and role == Qt.DisplayRole:
+            score = self.scores[row]
+            return f"{score:.2%}" if score == score else None
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() != self.LABEL:
+            return False
+        self.label_ids[index.row()] = self.labels.index(value)
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
+        return True
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if parent.isValid() or row < 0 or row + count > len(self.paths):
+            return False
+        self.beginRemoveRows(parent, row, row + count - 1)
+        del self.paths[row : row + count]
+        del self.label_ids[row : row + count]
+        del self.scores[row : row + count]
+        del self.ids[row : row + count]
+        self.endRemoveRows()
+        return True
+
+    def add_paths(self, paths):
+        # One insert notification for the whole selection
+        paths = list(paths)
+        if not paths:
+            return
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(paths) - 1)
+        self.paths.extend(paths)
+        self.label_ids.extend([self.default_label] * len(paths))
+        self.scores.extend([float("nan")] * len(paths))
+        self.ids.extend(range(self._next_id, self._next_id + len(paths)))
+        self._next_id += len(paths)
+        self.endInsertRows()
+
+    def set_results(self, rows, label_ids, scores):
+        # Store a batch of predictions with one change notification
+        rows = list(rows)
+        if not rows:
+            return
+        for row, label_id, score in zip(rows, label_ids, scores):
+            self.label_ids[row] = int(label_id)
+            self.scores[row] = float(score)
+        self.dataChanged.emit(
+            self.index(min(rows), self.LABEL),
+            self.index(max(rows), self.columnCount() - 1),
+        )
+
+    def rows_for_ids(self, ids):
+        # Current row of each id, or None once its row is removed. Rows are
+        # only ever appended, so the ids stay sorted
+        rows = []
+        for row_id in ids:
+            row = bisect.bisect_left(self.ids, row_id)
+            found = row < len(self.ids) and self.ids[row] == row_id
+            rows.append(row if found else None)
+        return rows
+
+    def path(self, row):
+        return self.paths[row]
+
+    def items(self):
+        # (path, label) for every row
+        return [
+            (path, self.labels[label_id] if label_id != NO_LABEL else None)
+            for path, label_id in zip(self.paths, self.label_ids)
+        ]
+
+    def _thumbnail_ready(self, path):
+        # Repaint the thumbnail column; the view only redraws visible rows
+        if self.paths:
+            self.dataChanged.emit(
+                self.index(0, self.PATH),
+                self.index(len(self.paths) - 1, self.PATH),
+                [Qt.DecorationRole],
+            )
+
+
+class LabelDelegate(QStyledItemDelegate):
+    # A combo box editor that only exists while a cell is being edited,
+    # instead of a widget per row
+    def __init__(self, labels, parent=None):
+        super().__init__(parent)
+        self.labels = list(labels)
+
+    def createEditor(self, parent, option, index):
+        editor = QComboBox(parent)
+        editor.addItems(self.labels)
+        # Commit as soon as a label is picked
+        editor.activated.connect(lambda: self.commitData.emit(editor))
+        return editor
+
+    def setEditorData(self, editor, index):
+        label = index.data(Qt.EditRole)
+        if label in self.labels:
+            editor.setCurrentIndex(self.labels.index(label))
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentText(), Qt.EditRole)
+
+
+def configure_view(view, thumbnail_size=THUMBNAIL_SIZE):
+    # Fixed row heights let the view lay out any number of rows without
+    # measuring them
+    header = view.verticalHeader()
+    header.setSectionResizeMode(QHeaderView.Fixed)
+    header.setDefaultSectionSize(thumbnail_size + 4)
+    view.setIconSize(QSize(thumbnail_size, thumbnail_size))
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.setWordWrap(False)
+    view.horizontalHeader().setStretchLastSection(True)
+
+
+def scaled_pixmap(path, height):
+    # Preview image for the side panel, decoded at display size
+    pixmap = QPixmap.fromImage(load_scaled(path, height))
+    if not pixmap.isNull() and pixmap.height() != height:
+        pixmap = pixmap.scaledToHeight(height)
+    return pixmap
@@ -0,0 +1,287 @@
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Image types tf.io.decode_image can read
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def rescale(images):
+    return images / 255.0
+
+
+def decode_image(path, img_size):
+    # Decode and resize a single image, keeping uint8 so cached data is small
+    image = tf.io.decode_image(
+        tf.io.read_file(path), channels=3, expand_animations=False
+    )
+    image = tf.image.resize(image, (img_size, img_size), method="nearest")
+    image.set_shape((img_size, img_size, 3))
+    return tf.cast(image, tf.uint8)
+
+
+def random_affine(
+    images,
+    seed,
+    rotation_range=20,
+    zoom_range=0.2,
+    shear_range=0.2,
+    horizontal_flip=True,
+):
+    # Vectorised equivalent of the ImageDataGenerator augmentation: one
+    # random rotation/shear/zoom/flip matrix per image, applied to the whole
+    # batch in a single projective transform. Angles are in degrees as in
+    # ImageDataGenerator, and seed is a stateless [2] int seed
+    images = tf.cast(images, tf.float32)
+    batch = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    seeds = tf.random.experimental.stateless_split(seed, 5)
+
+    def uniform(i, low, high):
+        return tf.random.stateless_uniform([batch], seeds[i], low, high)
+
+    theta = uniform(0, -rotation_range, rotation_range) * math.pi / 180
+    shear = uniform(1, -shear_range, shear_range) * math.pi / 180
+    zx = uniform(2, 1 - zoom_range, 1 + zoom_range)
+    zy = uniform(3, 1 - zoom_range, 1 + zoom_range)
+    flip = tf.ones([batch])
+    if horizontal_flip:
+        flip = tf.where(uniform(4, 0.0, 1.0) < 0.5, -1.0, 1.0)
+
+    def matrices(a, b, c, d):
+        return tf.reshape(tf.stack([a, b, c, d], axis=-1), [-1, 2, 2])
+
+    zeros, ones = tf.zeros([batch]), tf.ones([batch])
+    rotation = matrices(tf.cos(theta), -tf.sin(theta), tf.sin(theta), tf.cos(theta))
+    shearing = matrices(ones, -tf.sin(shear), zeros, tf.cos(shear))
+    zoom = matrices(zx * flip, zeros, zeros, zy)
+    matrix = rotation @ shearing @ zoom
+
+    # Transform about the image centre: input = M @ (output - c) + c
+    center = tf.stack([(width - 1) / 2, (height - 1) / 2])
+    offset = center - tf.linalg.matvec(matrix, center)
+    transforms = tf.stack(
+        [
+            matrix[:, 0, 0],
+            matrix[:, 0, 1],
+            offset[:, 0],
+            matrix[:, 1, 0],
+            matrix[:, 1, 1],
+            offset[:, 1],
+            zeros,
+            zeros,
+        ],
+        axis=-1,
+    )
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        fill_value=0.0,
+        interpolation="BILINEAR",
+        fill_mode="NEAREST",
+    )
+
+
+def image_batches(paths, img_size, batch_size=32, preprocess=rescale):
+    # Decode arbitrary image files in parallel into preprocessed batches
+    dataset = tf.data.Dataset.from_tensor_slices(list(paths))
+    dataset = dataset.map(
+        lambda path: decode_image(path, img_size), num_parallel_calls=AUTOTUNE
+    )
+    dataset = dataset.batch(batch_size).map(
+        lambda images: preprocess(tf.cast(images, tf.float32)),
+        num_parallel_calls=AUTOTUNE,
+    )
+    return dataset.prefetch(AUTOTUNE)
+
+
+class DirectoryDataset:
+    def __init__(self, directory, img_size=224, seed=0):
+        self.directory = directory
+        self.img_size = img_size
+        self.seed = seed
+
+        # Classes are the sorted sub-directories, as in flow_from_directory
+        self.class_names = []
+        if os.path.isdir(directory):
+            self.class_names = sorted(
+                name
+                for name in os.listdir(directory)
+                if os.path.isdir(os.path.join(directory, name))
+            )
+        self.class_indices = {name: i for i, name in enumerate(self.class_names)}
+
+        self.filepaths = []
+        classes = []
+        for name in self.class_names:
+            for root, dirs, files in os.walk(os.path.join(directory, name)):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        self.filepaths.append(os.path.join(root, filename))
+                        classes.append(self.class_indices[name])
+        self.classes = np.array(classes, dtype="int32")
+        self.samples = len(self.filepaths)
+        print(
+            f"Found {self.samples} images belonging to "
+            f"{len(self.class_names)} classes."
+        )
+
+    def dataset(
+        self,
+        batch_size=32,
+        augment=False,
+        shuffle=False,
+        repeat=False,
+        cache=True,
+        preprocess=rescale,
+    ):
+        # Parallel decode -> cache -> shuffle -> batch -> augment -> prefetch.
+        # cache may be True for memory or a filename for an on-disk cache
+        num_classes = len(self.class_names)
+        dataset = tf.data.Dataset.from_tensor_slices((self.filepaths, self.classes))
+        dataset = dataset.map(
+            lambda path, label: (decode_image(path, self.img_size), label),
+            num_parallel_calls=AUTOTUNE,
+        )
+        if cache:
+            dataset = dataset.cache("" if cache is True else cache)
+        if shuffle:
+            dataset = dataset.shuffle(max(self.samples, 1), seed=self.seed)
+        if repeat:
+            dataset = dataset.repeat()
+        dataset = dataset.batch(batch_size)
+        return prepare_batches(dataset, num_classes, self.seed, augment, preprocess)
+
+
+class ArrayDataset:
+    def __init__(self, images, rows, classes, class_names, seed=0, threads=None):
+        # Images already decoded into a (N, size, size, 3) uint8 array,
+        # usually a memory-mapped cache shared between processes. rows picks
+        # this dataset's images out of it, classes holds their labels
+        self.images = images
+        self.rows = np.asarray(rows, dtype="int64")
+        self.classes = np.asarray(classes, dtype="int32")
+        self.class_names = list(class_names)
+        self.img_size = images.shape[1]
+        self.seed = seed
+        # Size of the private tf.data thread pool, or None for the default
+        self.threads = threads
+        self.samples = len(self.rows)
+
+    def batches(self, batch_size, shuffle, repeat):
+        # Gather each batch from the array in row order, so reading a
+        # memory-mapped cache stays close to sequential
+        rng = np.random.default_rng(self.seed)
+        while True:
+            order = np.arange(self.samples)
+            if shuffle:
+                order = rng.permutation(self.samples)
+            for start in range(0, self.samples, batch_size):
+                chunk = order[start : start + batch_size]
+                chunk = chunk[np.argsort(self.rows[chunk])]
+                yield self.images[self.rows[chunk]], self.classes[chunk]
+            if not repeat:
+                return
+
+    def dataset(
+        self,
+        batch_size=32,
+        augment=False,
+        shuffle=False,
+        repeat=False,
+        cache=True,
+        preprocess=rescale,
+    ):
+        # Same batches as DirectoryDataset.dataset, without decoding; cache
+        # is ignored since the array already is one
+        size = self.img_size
+        dataset = tf.data.Dataset.from_generator(
+            lambda: self.batches(batch_size, shuffle, repeat),
+            output_signature=(
+                tf.TensorSpec((None, size, size, 3), tf.uint8),
+                tf.TensorSpec((None,), tf.int32),
+            ),
+        )
+        if self.threads:
+            options = tf.data.Options()
+            options.threading.private_threadpool_size = self.threads
+            dataset = dataset.with_options(options)
+        return prepare_batches(
+            dataset, len(self.class_names), self.seed, augment, preprocess
+        )
+
+
+def prepare_batches(dataset, num_classes, seed, augment=False, preprocess=rescale):
+    # Batched (uint8 images, class indices) -> augment -> preprocess and
+    # one-hot labels -> prefetch
+    if augment:
+        # A seeded stream of per-batch seeds keeps augmentation
+        # reproducible across runs while differing between epochs
+        seeds = tf.data.Dataset.random(
+            seed=seed, rerandomize_each_iteration=True
+        ).batch(2)
+        dataset = tf.data.Dataset.zip((dataset, seeds)).map(
+            lambda batch, seed: (random_affine(batch[0], seed), batch[1]),
+            num_parallel_calls=AUTOTUNE,
+        )
+
+    dataset = dataset.map(
+        lambda images, labels: (
+            preprocess(tf.cast(images, tf.float32)),
+            tf.one_hot(labels, num_classes),
+        ),
+        num_parallel_calls=AUTOTUNE,
+    )
+    return dataset.prefetch(AUTOTUNE)
+
+
+def measure_throughput(batches, steps):
+    # Images per second over steps batches, after one warm-up batch
+    iterator = iter(batches)
+    next(iterator)
+    images = 0
+    started = time.perf_counter()
+    for _ in range(steps):
+        images += len(next(iterator)[0])
+    return images / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    # Compare the old ImageDataGenerator input pipeline with tf.data
+    parser = argparse.ArgumentParser(description="Measure input pipeline speed.")
+    parser.add_argument("directory", nargs="?", default="../dataset/train")
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=50)
+    args = parser.parse_args()
+
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    generator = ImageDataGenerator(
+        rescale=1.0 / 255,
+        rotation_range=20,
+        zoom_range=0.2,
+        shear_range=0.2,
+        horizontal_flip=True,
+    ).flow_from_directory(
+        args.directory,
+        target_size=(args.img_size, args.img_size),
+        batch_size=args.batch_size,
+        class_mode="categorical",
+    )
+    before = measure_throughput(generator, args.steps)
+
+    data = DirectoryDataset(args.directory, args.img_size)
+    batches = data.dataset(args.batch_size, augment=True, shuffle=True, repeat=True)
+    after = measure_throughput(batches, args.steps)
+
+    print(f"ImageDataGenerator: {before:.1f} images/sec")
+    print(f"tf.data:            {after:.1f} images/sec ({after / before:.1f}x)")
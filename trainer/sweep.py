@@ -0,0 +1,413 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from feature_cache import FeatureCache, file_hash
+
+# TensorFlow is only imported inside the functions below, so every spawned
+# run can size its thread pools before TensorFlow starts
+
+BACKBONES = ("VGG19", "ResNet50", "InceptionV3", "MobileNetV2")
+
+
+def thread_budget(processes, threads=None):
+    # Split the cores between concurrent runs so their TensorFlow pools do
+    # not oversubscribe the machine
+    if threads:
+        return threads
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+def limit_threads(threads):
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def decode_split(data, cache, batch_size=32):
+    # Decode the images of one split that are not in the shared cache yet
+    # and return the cache row of every image
+    import tensorflow as tf
+
+    from pipeline import image_batches
+
+    hashes = [file_hash(path) for path in data.filepaths]
+    missing = {}
+    for image_hash, path in zip(hashes, data.filepaths):
+        if image_hash not in cache:
+            missing.setdefault(image_hash, path)
+    missing = list(missing.items())
+    if missing:
+        print(f"Decoding {len(missing)} images into the shared cache")
+        batches = image_batches(
+            [path for _, path in missing],
+            data.img_size,
+            batch_size,
+            preprocess=lambda images: tf.cast(images, tf.uint8),
+        )
+        for start, x in zip(range(0, len(missing), batch_size), batches):
+            chunk = missing[start : start + batch_size]
+            cache.add([h for h, _ in chunk], x.numpy())
+        cache.flush()
+    return [cache.rows[h] for h in hashes]
+
+
+def prepare_data(train_dir, val_dir, img_size, cache_dir):
+    # Decode both splits once into a memory-mapped uint8 cache, keyed by
+    # file hash like the feature cache. Runs map it read-only, so the pages
+    # are shared between processes and no run reads an image file
+    from pipeline import DirectoryDataset
+
+    cache = FeatureCache(
+        cache_dir,
+        f"decoded_{img_size}",
+        (img_size, img_size, 3),
+        signature="nearest-uint8",
+        dtype="uint8",
+    )
+    data = {"path": cache.features_path}
+    for split, directory in (("train", train_dir), ("validation", val_dir)):
+        dataset = DirectoryDataset(directory, img_size)
+        data["class_names"] = dataset.class_names
+        data[split] = {
+            "rows": decode_split(dataset, cache),
+            "classes": dataset.classes.tolist(),
+        }
+    return data
+
+
+def array_datasets(data, seed=0, threads=None):
+    from pipeline import ArrayDataset
+
+    images = np.load(data["path"], mmap_mode="r")
+    return [
+        ArrayDataset(
+            images,
+            data[split]["rows"],
+            data[split]["classes"],
+            data["class_names"],
+            seed=seed,
+            threads=threads,
+        )
+        for split in ("train", "validation")
+    ]
+
+
+def fetch_weights(backbones, img_size):
+    # Download the ImageNet weights once up front, so concurrent runs do not
+    # race to fetch the same file
+    import tensorflow as tf
+
+    for backbone in backbones:
+        getattr(tf.keras.applications, backbone)(
+            weights="imagenet",
+            include_top=False,
+            input_shape=(img_size, img_size, 3),
+        )
+        tf.keras.backend.clear_session()
+
+
+def train_run(run, data, threads, output_dir, training, weights, verbose):
+    # Train one backbone/hyperparameter setting on the shared decoded data
+    # in its own process, and save the model for the latency pass
+    limit_threads(threads)
+
+    from trainer import ImageClassifierTrainer, TrainingConfig
+
+    train_data, val_data = array_datasets(data, run["seed"], threads)
+    trainer = ImageClassifierTrainer(
+        run["backbone"],
+        img_size=train_data.img_size,
+        num_classes=len(data["class_names"]),
+        seed=run["seed"],
+        weights=weights,
+        learning_rate=run["learning_rate"],
+        train_data=train_data,
+        val_data=val_data,
+    )
+    prefix = os.path.join(output_dir, run["name"])
+    config = TrainingConfig(
+        batch_size=run["batch_size"],
+        checkpoint_path=prefix + ".weights.h5",
+        **training,
+    )
+    started = time.perf_counter()
+    history = trainer.train(config, verbose=verbose)
+    train_seconds = time.perf_counter() - started
+
+    metrics = trainer.model.evaluate(
+        val_data.dataset(run["batch_size"], preprocess=trainer.preprocess_input),
+        verbose=0,
+        return_dict=True,
+    )
+    model_path = prefix + ".h5"
+    trainer.save_model(model_path)
+    return dict(
+        run,
+        accuracy=round(float(metrics["accuracy"]), 4),
+        epochs=len(history.history["loss"]),
+        train_seconds=round(train_seconds, 1),
+        params=trainer.model.count_params(),
+        size_mb=round(os.path.getsize(model_path) / 1e6, 2),
+        model_path=model_path,
+    )
+
+
+def latency_run(result, data, threads, runs):
+    # Single-image latency of a trained model, measured on its own with the
+    # same thread budget as training, so runs are compared fairly
+    limit_threads(threads)
+
+    import tensorflow as tf
+
+    from export import PREPROCESSORS, measure_latency
+
+    model = tf.keras.models.load_model(result["model_path"], compile=False)
+    _, val_data = array_datasets(data)
+    images, _ = next(val_data.batches(1, shuffle=False, repeat=False))
+    single = PREPROCESSORS[result["backbone"]](images.astype("float32"))
+    p50, p95 = measure_latency(model.predict_on_batch, single, runs)
+    return {
+        "latency_p50_ms": round(p50 * 1000, 3),
+        "latency_p95_ms": round(p95 * 1000, 3),
+    }
+
+
+def pareto_front(results):
+    # Names of the runs no other run beats on accuracy, latency and size
+    # at once
+    front = set()
+    for r in results:
+        dominated = any(
+            o["accuracy"] >= r["accuracy"]
+            and o["latency_p50_ms"] <= r["latency_p50_ms"]
+            and o["size_mb"] <= r["size_mb"]
+            and (
+                o["accuracy"] > r["accuracy"]
+                or o["latency_p50_ms"] < r["latency_p50_ms"]
+                or o["size_mb"] < r["size_mb"]
+            )
+            for o in results
+        )
+        if not dominated:
+            front.add(r["name"])
+    return front
+
+
+def leaderboard(results, min_accuracy=None):
+    # With an accuracy bar, the runs that meet it come first, fastest
+    # first; otherwise (and below the bar) the most accurate come first
+    def key(r):
+        if min_accuracy is not None and r["accuracy"] >= min_accuracy:
+            return (0, r["latency_p50_ms"], -r["accuracy"])
+        return (1, -r["accuracy"], r["latency_p50_ms"])
+
+    front = pareto_front(results)
+    board = sorted(results, key=key)
+    for rank, r in enumerate(board, 1):
+        r["rank"] = rank
+        r["pareto"] = r["name"] in front
+    return board
+
+
+def print_leaderboard(board):
+    print(
+        f"{'rank':<6}{'run':<32}{'accuracy':>10}{'p50 ms':>10}"
+        f"{'p95 ms':>10}{'size MB':>10}{'epochs':>8}"
+    )
+    for r in board:
+        name = r["name"] + (" *" if r["pareto"] else "")
+        print(
+            f"{r['rank']:<6}{name:<32}{r['accuracy']:>10.4f}"
+            f"{r['latency_p50_ms']:>10.2f}{r['latency_p95_ms']:>10.2f}"
+            f"{r['size_mb']:>10.2f}{r['epochs']:>8}"
+        )
+    print("* on the accuracy/latency/size Pareto front")
+
+
+def sweep(
+    backbones,
+    learning_rates,
+    batch_sizes,
+    train_dir="../dataset/train",
+    val_dir="../dataset/validation",
+    img_size=224,
+    cache_dir="../dataset/features",
+    output_dir="sweep",
+    processes=2,
+    threads=None,
+    weights="imagenet",
+    training=None,
+    latency_runs=50,
+    seed=0,
+    verbose=0,
+):
+    # Train every combination, up to processes at a time, then time each
+    # model alone. Returns the results and the runs that failed
+    os.makedirs(output_dir, exist_ok=True)
+    runs = [
+        {
+            "name": f"{backbone}_lr{learning_rate:g}_bs{batch_size}",
+            "backbone": backbone,
+            "learning_rate": learning_rate,
+            "batch_size": batch_size,
+            "seed": seed,
+        }
+        for backbone, learning_rate, batch_size in itertools.product(
+            backbones, learning_rates, batch_sizes
+        )
+    ]
+    threads = thread_budget(processes, threads)
+    data = prepare_data(train_dir, val_dir, img_size, cache_dir)
+    if not data["validation"]["rows"]:
+        raise ValueError(f"No validation images found in {val_dir}")
+    if weights == "imagenet":
+        fetch_weights(sorted(set(backbones)), img_size)
+
+    # Spawned runs start with a clean interpreter and, with one task per
+    # child, hand all of their memory back when they finish
+    context = multiprocessing.get_context("spawn")
+    print(f"{len(runs)} runs, {processes} at a time with {threads} threads each")
+    results = []
+    failed = {}
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=context, max_tasks_per_child=1
+    ) as pool:
+        futures = {
+            pool.submit(
+                train_run,
+                run,
+                data,
+                threads,
+                output_dir,
+                training or {},
+                weights,
+                verbose,
+            ): run
+            for run in runs
+        }
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed[run["name"]] = str(e)
+                print(f"{run['name']} failed: {e}")
+                continue
+            results.append(result)
+            print(
+                f"[{len(results) + len(failed)}/{len(runs)}] {result['name']}: "
+                f"accuracy {result['accuracy']:.4f} after {result['epochs']} "
+                f"epochs ({result['train_seconds']:.0f}s)"
+            )
+
+    # One model at a time, so latencies are not skewed by other runs
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=context, max_tasks_per_child=1
+    ) as pool:
+        for result in results:
+            result.update(
+                pool.submit(latency_run, result, data, threads, latency_runs).result()
+            )
+    return results, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Train several backbones and settings in parallel and rank "
+        "them by validation accuracy, latency and size."
+    )
+    parser.add_argument("--backbones", nargs="+", choices=BACKBONES, default=BACKBONES)
+    parser.add_argument(
+        "--learning-rates", nargs="+", type=float, default=[0.001], metavar="LR"
+    )
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32], metavar="N")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--patience", type=int, default=3, help="early stopping")
+    parser.add_argument("--train-dir", default="../dataset/train")
+    parser.add_argument("--val-dir", default="../dataset/validation")
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument(
+        "--cache-dir",
+        default="../dataset/features",
+        help="where the decoded images are cached",
+    )
+    parser.add_argument("--output-dir", default="sweep")
+    parser.add_argument(
+        "--processes", type=int, default=2, help="runs trained at the same time"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="TensorFlow threads per run (default: cores / processes)",
+    )
+    parser.add_argument(
+        "--weights",
+        choices=["imagenet", "none"],
+        default="imagenet",
+        help="'none' trains from scratch, without downloading weights",
+    )
+    parser.add_argument(
+        "--min-accuracy",
+        type=float,
+        help="accuracy bar: rank the runs that meet it by latency",
+    )
+    parser.add_argument("--latency-runs", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose", action="store_true", help="print each run's epoch logs"
+    )
+    args = parser.parse_args(argv)
+
+    results, failed = sweep(
+        args.backbones,
+        args.learning_rates,
+        args.batch_sizes,
+        train_dir=args.train_dir,
+        val_dir=args.val_dir,
+        img_size=args.img_size,
+        cache_dir=args.cache_dir,
+        output_dir=args.output_dir,
+        processes=args.processes,
+        threads=args.threads,
+        weights=None if args.weights == "none" else args.weights,
+        training={"epochs": args.epochs, "early_stopping_patience": args.patience},
+        latency_runs=args.latency_runs,
+        seed=args.seed,
+        verbose=2 if args.verbose else 0,
+    )
+
+    board = leaderboard(results, args.min_accuracy)
+    if board:
+        print_leaderboard(board)
+    report_path = os.path.join(args.output_dir, "leaderboard.json")
+    with open(report_path, "w") as f:
+        json.dump({"leaderboard": board, "failed": failed}, f, indent=2)
+    print(f"Leaderboard written to {report_path}")
+
+    if args.min_accuracy is not None:
+        passing = [r for r in board if r["accuracy"] >= args.min_accuracy]
+        if passing:
+            best = passing[0]
+            print(
+                f"Fastest model with accuracy >= {args.min_accuracy}: "
+                f"{best['name']} ({best['model_path']})"
+            )
+        else:
+            print(f"No model reached accuracy {args.min_accuracy}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
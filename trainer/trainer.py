@@ -1,11 +1,52 @@
 # Import required libraries
-# import os
+import math
+import os
+import uuid
+
 import tensorflow as tf
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.applications import VGG19
 from tensorflow.keras.applications import ResNet50
 from tensorflow.keras.applications import InceptionV3
 from tensorflow.keras.applications import MobileNetV2
+from tensorflow.keras.applications import (
+    inception_v3,
+    mobilenet_v2,
+    resnet50,
+    vgg19,
+)
+
+from export import export_tflite
+from feature_cache import FeatureCache, file_hash
+from pipeline import DirectoryDataset, image_batches
+
+
+class TrainingConfig:
+    def __init__(
+        self,
+        epochs=10,
+        batch_size=32,
+        steps_per_epoch=None,
+        validation_steps=None,
+        early_stopping_patience=3,
+        min_delta=0.0,
+        checkpoint_path="best_model.weights.h5",
+    ):
+        # Upper bound on epochs; early stopping usually ends training sooner
+        self.epochs = epochs
+        self.batch_size = batch_size
+        # None derives the training steps from the dataset size so each
+        # epoch sees every image once, and validates on one exact pass
+        self.steps_per_epoch = steps_per_epoch
+        self.validation_steps = validation_steps
+        # Stop once the monitored loss has not improved by min_delta for
+        # this many epochs, and restore the best weights. None disables it
+        self.early_stopping_patience = early_stopping_patience
+        self.min_delta = min_delta
+        # Where the best weights are saved, or None to skip checkpointing
+        self.checkpoint_path = checkpoint_path
+
+    def steps_for(self, samples, steps=None):
+        return steps or max(1, math.ceil(samples / self.batch_size))
 
 
 class ImageClassifierTrainer:
@@ -16,36 +57,59 @@ class ImageClassifierTrainer:
         num_classes=4,
         train_dir="../dataset/train",
         val_dir="../dataset/validation",
+        feature_cache_dir="../dataset/features",
+        seed=0,
+        run_eagerly=False,
+        weights="imagenet",
+        learning_rate=0.001,
+        train_data=None,
+        val_data=None,
     ):
         # Define the input size and number of classes
+        self.model_name = model_name
         self.img_size = img_size
         self.num_classes = num_classes
+        self.feature_cache_dir = feature_cache_dir
+        # Cached features depend on the backbone weights: weight files are
+        # keyed by content, and random weights differ per trainer so their
+        # features are never reused
+        if weights is None:
+            self.weights_id = "random"
+            self._weights_signature = uuid.uuid4().hex
+        elif os.path.isfile(weights):
+            self.weights_id = self._weights_signature = file_hash(weights)[:16]
+        else:
+            self.weights_id = self._weights_signature = weights
 
         # Specify the pre-trained model to use
         if model_name == "VGG19":
             self.pretrained_model = VGG19(
-                weights="imagenet",
+                weights=weights,
                 include_top=False,
                 input_shape=(img_size, img_size, 3),
             )
+            self.preprocess_input = vgg19.preprocess_input
         elif model_name == "ResNet50":
             self.pretrained_model = ResNet50(
-                weights="imagenet",
+                weights=weights,
                 include_top=False,
                 input_shape=(img_size, img_size, 3),
             )
+            self.preprocess_input = resnet50.preprocess_input
         elif model_name == "InceptionV3":
             self.pretrained_model = InceptionV3(
-                weights="imagenet",
+                weights=weights,
                 include_top=False,
                 input_shape=(img_size, img_size, 3),
             )
+            self.preprocess_input = inception_v3.preprocess_input
         elif model_name == "MobileNetV2":
             self.pretrained_model = MobileNetV2(
-                weights="imagenet",
+                weights=weights,
                 include_top=False,
                 input_shape=(img_size, img_size, 3),
             )
+            self.preprocess_input = mobilenet_v2.preprocess_input
         else:
             raise ValueError(
                 "Invalid model name. " +
@@ -58,60 +122,191 @@ class ImageClassifierTrainer:
             layer.trainable = False
 
         # Add a new classifier on top
+        self.head_layers = [
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(512, activation="relu"),
+            tf.keras.layers.Dropout(0.5),
+            tf.keras.layers.Dense(num_classes, activation="softmax"),
+        ]
         x = self.pretrained_model.output
-        x = tf.keras.layers.Flatten()(x)
-        x = tf.keras.layers.Dense(512, activation="relu")(x)
-        x = tf.keras.layers.Dropout(0.5)(x)
-        predictions = tf.keras.layers.Dense(num_classes, activation="softmax")(x)
+        for layer in self.head_layers:
+            x = layer(x)
+        predictions = x
 
         # Define the new model
         self.model = tf.keras.models.Model(
             inputs=self.pretrained_model.input, outputs=predictions
         )
 
-        # Compile the model
-        self.model.compile(
-            optimizer="adam",
+        # The same head layers applied to cached backbone features. It shares
+        # its weights with self.model, so training it trains the full model
+        features = tf.keras.Input(shape=self.pretrained_model.output_shape[1:])
+        x = features
+        for layer in self.head_layers:
+            x = layer(x)
+        self.head_model = tf.keras.models.Model(inputs=features, outputs=x)
+        self.head_model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate),
             loss="categorical_crossentropy",
             metrics=["accuracy"],
-            run_eagerly=True
         )
 
-        # Define the data generators for training and validation
-        train_datagen = ImageDataGenerator(
-            rescale=1.0 / 255,
-            rotation_range=20,
-            zoom_range=0.2,
-            shear_range=0.2,
-            horizontal_flip=True,
+        # Compile the model, running in graph mode unless debugging eagerly
+        self.model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate),
+            loss="categorical_crossentropy",
+            metrics=["accuracy"],
+            run_eagerly=run_eagerly,
         )
 
-        val_datagen = ImageDataGenerator(rescale=1.0 / 255)
+        # Index the training and validation images for the tf.data pipelines,
+        # unless already decoded datasets are given
+        self.train_data = train_data or DirectoryDataset(train_dir, img_size, seed=seed)
+        self.val_data = val_data or DirectoryDataset(val_dir, img_size, seed=seed)
+
+    def callbacks(self, config, monitor, checkpoint=True):
+        callbacks = []
+        if config.early_stopping_patience is not None:
+            callbacks.append(
+                tf.keras.callbacks.EarlyStopping(
+                    monitor=monitor,
+                    patience=config.early_stopping_patience,
+                    min_delta=config.min_delta,
+                    restore_best_weights=True,
+                    verbose=1,
+                )
+            )
+        if checkpoint and config.checkpoint_path:
+            callbacks.append(
+                tf.keras.callbacks.ModelCheckpoint(
+                    config.checkpoint_path,
+                    monitor=monitor,
+                    save_best_only=True,
+                    save_weights_only=True,
+                    verbose=1,
+                )
+            )
+        return callbacks
 
-        self.train_generator = train_datagen.flow_from_directory(
-            train_dir,
-            target_size=(img_size, img_size),
-            batch_size=32,
-            class_mode="categorical",
+    def train(self, config=None, callbacks=(), verbose="auto"):
+        config = config or TrainingConfig()
+
+        # Build the input pipelines: augmented and shuffled for training
+        train_batches = self.train_data.dataset(
+            batch_size=config.batch_size,
+            augment=True,
+            shuffle=True,
+            repeat=True,
+            preprocess=self.preprocess_input,
         )
+        val_batches = None
+        if self.val_data.samples:
+            # Not repeated, so every epoch is validated on the same images
+            val_batches = self.val_data.dataset(
+                batch_size=config.batch_size,
+                preprocess=self.preprocess_input,
+            )
 
-        self.val_generator = val_datagen.flow_from_directory(
-            val_dir,
-            target_size=(img_size, img_size),
-            batch_size=32,
-            class_mode="categorical",
+        # Train the model, monitoring validation loss when there is any
+        monitor = "val_loss" if val_batches is not None else "loss"
+        return self.model.fit(
+            train_batches,
+            steps_per_epoch=config.steps_for(
+                self.train_data.samples, config.steps_per_epoch
+            ),
+            epochs=config.epochs,
+            validation_data=val_batches,
+            validation_steps=config.validation_steps,
+            callbacks=self.callbacks(config, monitor) + list(callbacks),
+            verbose=verbose,
         )
 
-    def train(self, epochs):
-        # Train the model
-        self.model.fit(
-            self.train_generator,
-            steps_per_epoch=self.train_generator.samples//epochs,
-            epochs=10,
-            validation_data=self.val_generator,
-            validation_steps=self.val_generator.samples//epochs,
+    def extract_features(self, data, batch_size=32, should_stop=None):
+        # Run the frozen backbone once per image and cache its activations,
+        # keyed by file hash, so later runs only pay for new images.
+        # should_stop() is checked between batches; when it returns True the
+        # features done so far are kept and None is returned
+        cache = FeatureCache(
+            self.feature_cache_dir,
+            f"{self.model_name}_{self.img_size}_{self.weights_id}",
+            self.pretrained_model.output_shape[1:],
+            signature=f"imagenet-preprocess:{self._weights_signature}",
+        )
+        hashes = [file_hash(path) for path in data.filepaths]
+        missing = {}
+        for image_hash, path in zip(hashes, data.filepaths):
+            if image_hash not in cache:
+                missing.setdefault(image_hash, path)
+        missing = list(missing.items())
+        if missing:
+            print(f"Extracting {self.model_name} features for {len(missing)} images")
+            # Decode in parallel with the same preprocessing as validation
+            batches = image_batches(
+                [path for _, path in missing],
+                self.img_size,
+                batch_size,
+                preprocess=self.preprocess_input,
+            )
+            for start, x in zip(range(0, len(missing), batch_size), batches):
+                if should_stop is not None and should_stop():
+                    cache.flush()
+                    return None
+                chunk = missing[start : start + batch_size]
+                features = self.pretrained_model.predict_on_batch(x)
+                cache.add([h for h, _ in chunk], features)
+            cache.flush()
+
+        labels = tf.keras.utils.to_categorical(data.classes, self.num_classes)
+        return cache.get(hashes), labels
+
+    def train_on_features(
+        self, config=None, callbacks=(), verbose="auto", should_stop=None
+    ):
+        # Train only the classifier head on cached backbone features. Images
+        # are not augmented in this mode since each one is featurised once.
+        # Returns None if should_stop() interrupted the feature extraction
+        config = config or TrainingConfig()
+        train = self.extract_features(self.train_data, config.batch_size, should_stop)
+        if train is None:
+            return None
+        train_x, train_y = train
+        validation_data = None
+        if self.val_data.samples:
+            validation_data = self.extract_features(
+                self.val_data, config.batch_size, should_stop
+            )
+            if validation_data is None:
+                return None
+
+        monitor = "val_loss" if validation_data is not None else "loss"
+        history = self.head_model.fit(
+            train_x,
+            train_y,
+            batch_size=config.batch_size,
+            epochs=config.epochs,
+            shuffle=True,
+            validation_data=validation_data,
+            callbacks=self.callbacks(config, monitor, checkpoint=False)
+            + list(callbacks),
+            verbose=verbose,
         )
 
+        # Epochs are cheap here, so the best weights are checkpointed once at
+        # the end, as full-model weights like the end-to-end mode saves
+        if config.checkpoint_path:
+            self.model.save_weights(config.checkpoint_path)
+        return history
+
     def save_model(self, model_filename):
         # Save the trained model
         self.model.save(model_filename)
+
+    def export_tflite(self, output_prefix, samples=100):
+        # Quantize for CPU serving, calibrating on the training images
+        return export_tflite(
+            self.model,
+            output_prefix,
+            self.model_name,
+            calibration_dir=self.train_data.directory,
+            samples=samples,
+        )
@@ -1,6 +1,4 @@
 import sys
-import os
-import re
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -12,17 +10,27 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QFileDialog,
     QComboBox,
-    QPlainTextEdit,
     QToolBar,
     QToolButton,
-    QMenu
+    QMenu,
+    QProgressBar,
+    QAbstractItemView,
 )
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QTextCursor
-import shutil
+from PyQt5.QtCore import Qt, QThread
+
+from console import Console
+from image_table import (
+    ImageTableModel,
+    LabelDelegate,
+    ThumbnailCache,
+    configure_view,
+    scaled_pixmap,
+)
+from trainer import TrainingConfig
+from training_worker import TrainingWorker
 
-from trainer import ImageClassifierTrainer
+LABELS = ["Ripe", "Unripe", "Semi Ripe", "Overripe"]
+BACKBONES = ["VGG19", "ResNet50", "InceptionV3", "MobileNetV2"]
 
 
 class MainWindow(QMainWindow):
@@ -39,10 +47,25 @@ class MainWindow(QMainWindow):
             | Qt.WindowCloseButtonHint
         )
 
-        # Create a data model for the table
-        self.model = QStandardItemModel(0, 2, self)
-        self.model.setHorizontalHeaderLabels(["File Name", "Ripeness"])
+        # Create a data model for the table. Labels are edited through a
+        # delegate, so no widgets are created per row
+        self.thumbnails = ThumbnailCache(parent=self)
+        self.model = ImageTableModel(
+            LABELS,
+            ["File Name", "Ripeness"],
+            editable=True,
+            default_label=0,
+            thumbnails=self.thumbnails,
+            parent=self,
+        )
         self.table_view.setModel(self.model)
+        self.table_view.setItemDelegateForColumn(
+            ImageTableModel.LABEL, LabelDelegate(LABELS, self.table_view)
+        )
+        self.table_view.setEditTriggers(
+            QAbstractItemView.CurrentChanged | QAbstractItemView.SelectedClicked
+        )
+        configure_view(self.table_view)
 
         # Create an image preview widget
         self.image_label = QLabel(self)
@@ -55,11 +78,36 @@ class MainWindow(QMainWindow):
         self.button1.clicked.connect(self.add_images)
         self.button2.clicked.connect(self.train_model)
 
+        # Create the backbone selector, defaulting to MobileNetV2 as the
+        # fastest to serve
+        self.backbone_combo = QComboBox(self)
+        self.backbone_combo.addItems(BACKBONES)
+        self.backbone_combo.setCurrentText("MobileNetV2")
+
+        # Create the training progress widgets
+        self.training_thread = None
+        self.training_worker = None
+        self.progress_bar = QProgressBar(self)
+        self.status_label = QLabel(self)
+        self.pause_button = QPushButton("Pause", self)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.cancel_button.clicked.connect(self.cancel_training)
+
         # Create a horizontal layout to hold the image and buttons
         image_layout = QVBoxLayout()
         image_layout.addWidget(self.image_label)
         image_layout.addWidget(self.button1)
+        image_layout.addWidget(self.backbone_combo)
         image_layout.addWidget(self.button2)
+        image_layout.addWidget(self.progress_bar)
+        image_layout.addWidget(self.status_label)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(self.pause_button)
+        buttons_layout.addWidget(self.cancel_button)
+        image_layout.addLayout(buttons_layout)
 
         # Create a horizontal layout to hold the table and image layouts
         table_widget = QWidget(self)
@@ -73,11 +121,9 @@ class MainWindow(QMainWindow):
         # Connect the clicked signal of the table view to a custom slot
         self.table_view.clicked.connect(self.handle_table_click)
 
-        self.text_edit = QPlainTextEdit()
-        # Redirect terminal output to the log
-        sys.stdout = self
-        # Initialize the output buffer
-        self.buffer = ""
+        # Buffered log of print() output and log records, safe to write to
+        # from worker threads
+        self.text_edit = Console(self)
         image_layout.addWidget(self.text_edit)
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
@@ -95,79 +141,105 @@ class MainWindow(QMainWindow):
         if index.isValid():
             self.table_view.model().removeRow(index.row())
 
-    def write(self, message):
-        # Append the message to the output buffer
-        self.buffer += message
-
-        # If a newline character is encountered, flush the buffer to the log
-        if "\n" in message:
-            lines = self.buffer.split("\n")
-            for line in lines[:-1]:
-                # Write each line to the log
-                line = re.sub(r"[^\x20-\x7E]+", "", line)
-                self.text_edit.moveCursor(QTextCursor.End)
-                self.text_edit.insertPlainText(line + "\n")
-            # Clear the buffer
-            self.buffer = lines[-1]
-
-    def flush(self):
-        pass
-
     def show_image(self, filename):
-        pixmap = QPixmap(filename)
-        pixmap = pixmap.scaledToHeight(200)
-        self.image_label.setPixmap(pixmap)
+        self.image_label.setPixmap(scaled_pixmap(filename, 200))
 
     def add_images(self):
         files, _ = QFileDialog.getOpenFileNames(
             self, "Open file", "", "Images (*.png *.xpm *.jpg *.bmp *.gif)"
         )
-        for i, file in enumerate(files):
-            self.show_image(file)
-            row = self.model.rowCount()
-            self.model.insertRow(row)
-            combo_box = QComboBox(self)
-            combo_box.addItems(["Ripe", "Unripe", "Semi Ripe", "Overripe"])
-            for column in range(1):
-                self.model.setItem(row, 0, QStandardItem(file))
-                self.table_view.setIndexWidget(self.model.index(row, 1), combo_box)
+        if files:
+            self.model.add_paths(files)
+            self.show_image(files[-1])
 
     def handle_table_click(self, index):
         # Get the selected row and column index
         index = self.table_view.selectedIndexes()[0]
         row = index.row()
-        self.show_image(self.model.item(row, 0).text())
+        self.show_image(self.model.path(row))
 
     def train_model(self):
-        num_rows = self.model.rowCount()
-
-        # Create the folders if they don't exist
-        for folder in ["Ripe", "Unripe", "Semi Ripe", "Overripe"]:
-            if not os.path.exists(f"../dataset/train/{folder}"):
-                print(f"Creating {folder} folder for training")
-                os.makedirs(f"../dataset/train/{folder}")
-            if not os.path.exists(f"../dataset/validation/{folder}"):
-                print(f"Creating {folder} folder for validation")
-                os.makedirs(f"../dataset/validation/{folder}")
-
-        for row in range(num_rows):
-            # Get the combo box widget for the current row
-            combo_box = self.table_view.indexWidget(self.model.index(row, 1))
-            # Get the selected item from the combo box
-            item_data = combo_box.currentText()
-            print(f"{row}: {item_data} {self.model.item(row, 0).text()}")
-            # get the file extension
-            file_extension = self.model.item(row, 0).text().split(".")[-1]
-            # Transfer the image to the appropriate folder
-            shutil.copy(
-                self.model.item(row, 0).text(),
-                f"../dataset/train/{item_data}/image_{row}.{file_extension}",
-            )
-            print(f"copying to ../dataset/train/{item_data}/image_{row}.{file_extension}")
-        # Train the model
-        trainer = ImageClassifierTrainer("VGG19")
-        trainer.train(num_rows)
-        trainer.save_model("model.h5")
+        if self.training_thread is not None:
+            return
+        # Every row is labeled, new rows default to the first label
+        items = self.model.items()
+
+        # Ingest and train on a background thread so labeling can continue
+        self.training_thread = QThread(self)
+        self.training_worker = TrainingWorker(
+            items,
+            LABELS,
+            model_name=self.backbone_combo.currentText(),
+            config=TrainingConfig(),
+        )
+        self.training_worker.moveToThread(self.training_thread)
+        self.training_thread.started.connect(self.training_worker.run)
+        self.training_worker.batch_progress.connect(self.training_batch_progress)
+        self.training_worker.epoch_progress.connect(self.training_epoch_progress)
+        self.training_worker.failed.connect(self.training_failed)
+        self.training_worker.finished.connect(self.training_finished)
+
+        self.button2.setEnabled(False)
+        self.pause_button.setEnabled(True)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.status_label.setText("Preparing dataset...")
+        self.training_thread.start()
+
+    def toggle_pause(self):
+        if self.pause_button.text() == "Pause":
+            self.training_worker.pause()
+            self.pause_button.setText("Resume")
+            self.status_label.setText("Paused")
+        else:
+            self.training_worker.resume()
+            self.pause_button.setText("Pause")
+
+    def cancel_training(self):
+        self.training_worker.cancel()
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("Cancelling...")
+
+    def training_batch_progress(self, progress):
+        self.progress_bar.setMaximum(progress["steps"])
+        self.progress_bar.setValue(progress["step"])
+        if self.pause_button.text() == "Resume" or self.training_worker.cancelled:
+            return
+        eta = int(progress["eta_sec"])
+        self.status_label.setText(
+            f"Epoch {progress['epoch']}/{progress['epochs']} - "
+            f"loss {progress.get('loss', 0):.4f} - "
+            f"accuracy {progress.get('accuracy', 0):.4f} - "
+            f"{progress['images_per_sec']:.1f} images/sec - "
+            f"ETA {eta // 60}:{eta % 60:02d}"
+        )
+
+    def training_epoch_progress(self, progress):
+        metrics = " - ".join(
+            f"{name} {value:.4f}"
+            for name, value in progress.items()
+            if name not in ("epoch", "epochs")
+        )
+        print(f"Epoch {progress['epoch']}/{progress['epochs']}: {metrics}")
+
+    def training_failed(self, message):
+        print(f"Training failed: {message}")
+
+    def training_finished(self, model_filename):
+        self.training_thread.quit()
+        self.training_thread.wait()
+        self.training_worker.deleteLater()
+        self.training_thread.deleteLater()
+        self.training_thread = None
+        self.training_worker = None
+        self.button2.setEnabled(True)
+        self.pause_button.setEnabled(False)
+        self.pause_button.setText("Pause")
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText(
+            f"Saved {model_filename}" if model_filename else "Training stopped"
+        )
 
 
 if __name__ == "__main__":
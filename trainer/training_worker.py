@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+
+import tensorflow as tf
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from dataset_store import DatasetStore
+from trainer import ImageClassifierTrainer, TrainingConfig
+
+log = logging.getLogger(__name__)
+
+
+class ProgressCallback(tf.keras.callbacks.Callback):
+    def __init__(self, worker, batch_size):
+        super().__init__()
+        self.worker = worker
+        self.batch_size = batch_size
+
+    def on_train_begin(self, logs=None):
+        self.steps = self.params.get("steps") or 1
+        self.epochs = self.params.get("epochs") or 1
+        self.epoch = 0
+        self.started = time.perf_counter()
+        self.paused_for = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        # Pausing blocks the training thread here, between batches
+        self.paused_for += self.worker.wait_if_paused()
+        if self.worker.cancelled:
+            self.model.stop_training = True
+
+        done = self.epoch * self.steps + batch + 1
+        total = self.epochs * self.steps
+        elapsed = max(time.perf_counter() - self.started - self.paused_for, 1e-9)
+        progress = dict(logs or {})
+        progress.update(
+            {
+                "epoch": self.epoch + 1,
+                "epochs": self.epochs,
+                "step": done,
+                "steps": total,
+                "images_per_sec": done * self.batch_size / elapsed,
+                "eta_sec": (total - done) * elapsed / done,
+            }
+        )
+        self.worker.batch_progress.emit(progress)
+
+    def on_epoch_end(self, epoch, logs=None):
+        progress = dict(logs or {})
+        progress.update({"epoch": epoch + 1, "epochs": self.epochs})
+        self.worker.epoch_progress.emit(progress)
+
+
+class TrainingWorker(QObject):
+    # Metric dicts: loss, accuracy, images_per_sec, eta_sec, step counts
+    batch_progress = pyqtSignal(object)
+    epoch_progress = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    # Emitted with the saved model path, or "" if training was cancelled
+    finished = pyqtSignal(str)
+
+    def __init__(
+        self,
+        items,
+        labels,
+        model_name="VGG19",
+        config=None,
+        model_filename="model.h5",
+        dataset_root="../dataset",
+    ):
+        super().__init__()
+        self.items = list(items)
+        self.labels = list(labels)
+        self.model_name = model_name
+        self.config = config or TrainingConfig()
+        self.model_filename = model_filename
+        self.dataset_root = dataset_root
+        self.cancelled = False
+        self._resume = threading.Event()
+        self._resume.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._resume.set()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def wait_if_paused(self):
+        # Returns how long training was paused for
+        if self._resume.is_set():
+            return 0.0
+        started = time.perf_counter()
+        self._resume.wait()
+        return time.perf_counter() - started
+
+    def should_stop(self):
+        # Checked between steps outside fit: blocks while paused and returns
+        # True once cancelled
+        self.wait_if_paused()
+        return self.cancelled
+
+    def _items(self):
+        for item in self.items:
+            if self.should_stop():
+                return
+            yield item
+
+    def run(self):
+        saved = ""
+        try:
+            # Link only new or relabeled images into the dataset
+            store = DatasetStore(self.dataset_root, labels=self.labels)
+            counts = store.ingest(self._items())
+            log.info(
+                "Dataset: %d added, %d relabeled, %d unchanged",
+                counts["added"],
+                counts["relabeled"],
+                counts["unchanged"],
+            )
+            if self.cancelled:
+                return
+
+            # Train the model, reporting progress through the callback
+            trainer = ImageClassifierTrainer(
+                self.model_name,
+                train_dir=os.path.join(self.dataset_root, "train"),
+                val_dir=os.path.join(self.dataset_root, "validation"),
+                feature_cache_dir=os.path.join(self.dataset_root, "features"),
+            )
+            trainer.train_on_features(
+                self.config,
+                callbacks=[ProgressCallback(self, self.config.batch_size)],
+                verbose=0,
+                should_stop=self.should_stop,
+            )
+            if self.cancelled:
+                log.info("Training cancelled")
+                return
+            trainer.save_model(self.model_filename)
+            saved = self.model_filename
+            log.info("Saved %s", saved)
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            self.finished.emit(saved)
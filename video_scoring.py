@@ -0,0 +1,243 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from prediction import BACKBONES, load_classifier
+from profiling import profiler
+from score import find_images
+
+FIELDS = ["frame", "timestamp", "label", "accuracy", "duplicate"]
+
+
+def dhash(frame):
+    # 64-bit difference hash of a BGR frame: cheap and stable under noise,
+    # small shifts and exposure changes
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+class FrameReader:
+    # Reads frames on its own thread from a video file, a directory of
+    # images or a camera, resized to the model input. Files are read with
+    # backpressure; a camera drops the oldest frames when scoring falls
+    # behind
+    def __init__(self, source, image_size, fps=30.0, queue_size=64):
+        self.image_size = image_size
+        self.dropped = 0
+        self.paths = None
+        self.capture = None
+        if str(source).isdigit():
+            self.capture = cv2.VideoCapture(int(source))
+            self.live = True
+        elif os.path.isdir(source):
+            self.paths = find_images([source])
+            self.live = False
+        else:
+            self.capture = cv2.VideoCapture(source)
+            self.live = False
+        if self.capture is not None and not self.capture.isOpened():
+            raise RuntimeError(f"Could not open video source {source!r}")
+        self.fps = fps
+        self.frames = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _read(self, index, started):
+        # (ok, timestamp in seconds, BGR frame)
+        if self.paths is not None:
+            if index >= len(self.paths):
+                return False, None, None
+            return True, index / self.fps, cv2.imread(self.paths[index])
+        ok, frame = self.capture.read()
+        if self.live:
+            return ok, time.perf_counter() - started, frame
+        return ok, self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000, frame
+
+    def _run(self):
+        index = 0
+        started = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                with profiler.stage("read"):
+                    ok, timestamp, frame = self._read(index, started)
+                if not ok:
+                    break
+                if frame is None:
+                    # An unreadable image in a sequence
+                    index += 1
+                    continue
+                with profiler.stage("resize"):
+                    height, width = self.image_size
+                    pixels = cv2.resize(
+                        frame, (width, height), interpolation=cv2.INTER_NEAREST
+                    )
+                    pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+                self._put((index, timestamp, pixels, dhash(frame)))
+                index += 1
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        if self.live and item is not None:
+            while True:
+                try:
+                    self.frames.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self.frames.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        while not self._stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        if self.capture is not None:
+            self.capture.release()
+
+
+def iter_frame_results(
+    classifier, reader, batch_size=32, dedup_threshold=None, max_wait=0.1
+):
+    # Yield one record per frame, in order. Frames whose hash is within
+    # dedup_threshold bits of the last scored frame reuse its prediction
+    # instead of going through the model
+    pending = []
+    batch = []
+    last_hash = None
+    last_result = None
+    flush_at = time.perf_counter() + max_wait
+
+    def flush():
+        nonlocal last_result
+        results = iter(classifier.classify_arrays(batch, batch_size=len(batch) or 1))
+        for record in pending:
+            if not record["duplicate"]:
+                last_result = next(results)
+            record.update(last_result or {"label": None, "accuracy": None})
+            yield {name: record[name] for name in FIELDS}
+        pending.clear()
+        batch.clear()
+
+    for index, timestamp, pixels, frame_hash in reader:
+        duplicate = (
+            dedup_threshold is not None
+            and last_hash is not None
+            and bin(frame_hash ^ last_hash).count("1") <= dedup_threshold
+        )
+        if not duplicate:
+            last_hash = frame_hash
+            batch.append(pixels)
+        pending.append(
+            {"frame": index, "timestamp": round(timestamp, 3), "duplicate": duplicate}
+        )
+        # Live sources also flush on a timer so results keep flowing
+        if len(batch) >= batch_size or (
+            reader.live and batch and time.perf_counter() >= flush_at
+        ):
+            yield from flush()
+            flush_at = time.perf_counter() + max_wait
+    if pending:
+        yield from flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Score coffee cherry ripeness frame by frame."
+    )
+    parser.add_argument(
+        "source", help="video file, directory of images, or camera number"
+    )
+    parser.add_argument("-o", "--output", required=True, help="CSV or JSONL file")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None)
+    parser.add_argument(
+        "--model", help="custom .h5 or .tflite model (default: pretrained)"
+    )
+    parser.add_argument(
+        "--backbone",
+        choices=list(BACKBONES),
+        help="backbone of the pretrained model (custom models are detected)",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--dedup",
+        type=int,
+        default=None,
+        metavar="BITS",
+        help="reuse the last prediction for frames whose 64-bit hash differs "
+        "by at most BITS (e.g. 4)",
+    )
+    parser.add_argument(
+        "--fps", type=float, default=30.0, help="frame rate of image directories"
+    )
+    args = parser.parse_args(argv)
+
+    output_format = args.format or (
+        "jsonl" if args.output.endswith((".jsonl", ".json")) else "csv"
+    )
+    classifier = load_classifier(
+        pretrained=args.model is None, model_path=args.model, backbone=args.backbone
+    )
+    classifier.warmup()
+
+    reader = FrameReader(
+        args.source, (classifier.img_height, classifier.img_width), fps=args.fps
+    )
+    frames = scored = 0
+    started = time.perf_counter()
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if output_format == "csv":
+            writer.writeheader()
+        try:
+            for record in iter_frame_results(
+                classifier, reader, args.batch_size, args.dedup
+            ):
+                if output_format == "jsonl":
+                    f.write(json.dumps(record) + "\n")
+                else:
+                    writer.writerow(record)
+                frames += 1
+                scored += not record["duplicate"]
+        except KeyboardInterrupt:
+            print("Interrupted", file=sys.stderr)
+        finally:
+            reader.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{frames} frames ({scored} scored, {frames - scored} duplicates, "
+        f"{reader.dropped} dropped) in {elapsed:.2f}s "
+        f"({frames / elapsed if elapsed else 0:.1f} frames/sec)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())